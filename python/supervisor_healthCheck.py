@@ -9,25 +9,39 @@
 import os
 import sys
 import time
+import re
 import json
 import yaml
+import errno
+import atexit
+import fnmatch
+import zlib
+import math
+import array
+import heapq
+import select
 import base64
 import socket
 import signal
 import smtplib
 import datetime
+import functools
+import importlib
 import platform
 import threading
 import subprocess
 from email.header import Header
 from email.mime.text import MIMEText
-from collections import namedtuple
+from collections import namedtuple, deque
 from supervisor.xmlrpc import SupervisorTransport
 
 PY3 = sys.version_info[0] == 3
 
 if PY3:
+    import queue
     import http.client as httplib
+    from socketserver import ThreadingMixIn
+    from http.server import BaseHTTPRequestHandler, HTTPServer
     from xmlrpc.client import Transport, ServerProxy, Fault
 
 
@@ -38,7 +52,10 @@ if PY3:
     def iteritems(d, **kw):
         return iter(d.items(**kw))
 else:
+    import Queue as queue
     import httplib
+    from SocketServer import ThreadingMixIn
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
     from xmlrpclib import Transport, ServerProxy, Fault
 
 
@@ -68,9 +85,621 @@ def shell(cmd):
     return (proc.returncode,) + proc.communicate()
 
 
-def get_proc_cpu(pid):
+ProcInfo = namedtuple('ProcInfo', ['pid', 'ppid', 'rss'])
+ProcStat = namedtuple('ProcStat', ['pid', 'ppid', 'state', 'cpu_time', 'start_time', 'rss'])
+
+HAS_PROCFS = os.path.exists('/proc/self/stat')
+try:
+    CLK_TCK = os.sysconf('SC_CLK_TCK')
+    PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+except (AttributeError, ValueError):
+    CLK_TCK = 100
+    PAGE_SIZE = 4096
+
+
+def build_children(procs):
+    """
+    建立父进程到子进程的索引
+    :param procs: ProcInfo或ProcStat列表
+    :return: {ppid: [proc, ...]}
+    """
+    children = {}
+    for proc in procs:
+        children.setdefault(proc.ppid, []).append(proc)
+    return children
+
+
+def find_children(parent_pid, children):
+    """
+    广度优先找出进程的所有子孙进程, 每个进程只访问一次
+    :param parent_pid:
+    :param children: build_children 建立的索引
+    :return:
+    """
+    result = []
+    seen = set([parent_pid])
+    pending = deque([parent_pid])
+    while pending:
+        for proc in children.get(pending.popleft(), []):
+            if proc.pid in seen:
+                continue
+            seen.add(proc.pid)
+            result.append(proc)
+            pending.append(proc.pid)
+    return result
+
+
+def tree_rss(procs, pid):
+    """
+    统计进程及其子孙进程的rss
+    :param procs: ProcInfo或ProcStat列表
+    :param pid:
+    :return: rss, 单位KB; 没有此pid时返回None
+    """
+    parent_proc = None
+    for proc in procs:
+        if proc.pid == pid:
+            parent_proc = proc
+            break
+    if parent_proc is None:
+        return None
+    return parent_proc.rss + sum([p.rss for p in find_children(pid, build_children(procs))])
+
+
+def read_proc_stat(pid):
+    """
+    读取 /proc/<pid>/stat
+    :param pid:
+    :return: ProcStat, rss单位为KB, cpu_time和start_time单位为jiffies; 进程不存在时返回None
+    """
+    try:
+        pid = int(pid)
+        with open('/proc/%d/stat' % pid) as f:
+            data = f.read()
+        # 进程名中可能包含空格和括号, 从最后一个')'之后开始解析
+        fields = data[data.rfind(')') + 2:].split()
+        return ProcStat(pid=pid, ppid=int(fields[1]), state=fields[0],
+                        cpu_time=int(fields[11]) + int(fields[12]),
+                        start_time=int(fields[19]),
+                        rss=int(fields[21]) * PAGE_SIZE // 1024)
+    except (IOError, OSError, ValueError, IndexError):
+        return None
+
+
+def read_proc_statm(pid):
+    """
+    读取 /proc/<pid>/statm 中的常驻内存
+    :param pid:
+    :return: rss, 单位KB; 进程不存在时返回None
+    """
+    try:
+        with open('/proc/%d/statm' % int(pid)) as f:
+            return int(f.read().split()[1]) * PAGE_SIZE // 1024
+    except (IOError, OSError, ValueError, IndexError):
+        return None
+
+
+def read_proc_status(pid):
+    """
+    读取 /proc/<pid>/status
+    :param pid:
+    :return: dict, 如 {'VmRSS': '1024 kB', 'Threads': '4'}; 进程不存在时返回None
+    """
+    status = {}
+    try:
+        with open('/proc/%d/status' % int(pid)) as f:
+            for line in f:
+                key, _, value = line.partition(':')
+                status[key] = value.strip()
+    except (IOError, OSError, ValueError):
+        return None
+    return status
+
+
+def read_proc_smaps_rollup(pid):
+    """
+    读取 /proc/<pid>/smaps_rollup (内核4.14+), 用于计算PSS和USS
+    :param pid:
+    :return: dict, 如 {'Rss': 1024, 'Pss': 800, 'Private_Dirty': 600}, 单位KB; 无法读取时返回None
+    """
+    rollup = {}
+    try:
+        with open('/proc/%d/smaps_rollup' % int(pid)) as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) == 3 and fields[2] == 'kB':
+                    rollup[fields[0].rstrip(':')] = int(fields[1])
+    except (IOError, OSError, ValueError):
+        return None
+    return rollup
+
+
+def read_proc_mem(pid, mem_type='rss', rss=None):
+    """
+    获取单个进程的内存
+    :param pid:
+    :param mem_type: rss,pss,uss; pss按共享进程数均摊共享内存, uss只统计进程独占的内存
+    :param rss: 已知的rss值, mem_type为rss时直接返回
+    :return: 单位KB, 无法读取时返回None
+    """
+    if mem_type == 'rss':
+        return rss if rss is not None else read_proc_statm(pid)
+    rollup = read_proc_smaps_rollup(pid)
+    if not rollup:
+        return None
+    if mem_type == 'pss':
+        return rollup.get('Pss')
+    return rollup.get('Private_Clean', 0) + rollup.get('Private_Dirty', 0)
+
+
+def read_proc_cmdline(pid):
+    """
+    读取 /proc/<pid>/cmdline
+    :param pid:
+    :return: 以空格连接的命令行, 内核线程为空字符串; 无法读取时返回None
+    """
+    try:
+        with open('/proc/%d/cmdline' % int(pid), 'rb') as f:
+            data = f.read()
+    except (IOError, OSError, ValueError):
+        return None
+    return data.rstrip(b'\0').replace(b'\0', b' ').decode('utf-8', 'replace')
+
+
+def read_proc_fds(pid):
+    """
+    读取 /proc/<pid>/fd 下所有文件描述符指向的目标
+    :param pid:
+    :return: list, 如 ['/dev/null', 'socket:[12345]']; 无法读取时返回None
+    """
+    fd_dir = '/proc/%d/fd' % int(pid)
+    targets = []
+    try:
+        for fd in os.listdir(fd_dir):
+            try:
+                targets.append(os.readlink(os.path.join(fd_dir, fd)))
+            except OSError:
+                # 读取过程中fd已关闭
+                continue
+    except OSError:
+        return None
+    return targets
+
+
+def read_proc_io(pid):
+    """
+    读取 /proc/<pid>/io
+    :param pid:
+    :return: dict, 如 {'read_bytes': 4096, 'write_bytes': 0}; 无法读取时返回None
+    """
+    io = {}
+    try:
+        with open('/proc/%d/io' % int(pid)) as f:
+            for line in f:
+                key, _, value = line.partition(':')
+                io[key] = int(value)
+    except (IOError, OSError, ValueError):
+        return None
+    return io
+
+
+def find_cgroup2_mount():
+    """
+    从 /proc/mounts 中查找cgroup v2的挂载点, 兼容混合模式下挂载在 /sys/fs/cgroup/unified 的情况
+    :return: 挂载点, 没有挂载cgroup v2时返回None
+    """
+    try:
+        with open('/proc/mounts') as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) > 2 and fields[2] == 'cgroup2':
+                    return fields[1]
+    except (IOError, OSError):
+        pass
+    return None
+
+
+CGROUP2_ROOT = find_cgroup2_mount()
+
+
+def read_proc_cgroup(pid):
+    """
+    读取 /proc/<pid>/cgroup 中cgroup v2的路径, 即 0::/path 这一行
+    :param pid:
+    :return: 如 /system.slice/app.service; 无法读取或没有cgroup v2时返回None
+    """
+    try:
+        with open('/proc/%d/cgroup' % int(pid)) as f:
+            for line in f:
+                if line.startswith('0::'):
+                    return line[3:].strip()
+    except (IOError, OSError, ValueError):
+        return None
+    return None
+
+
+def read_cgroup_stat(path, name):
+    """
+    读取cgroup中 key value 格式的统计文件, 如 memory.stat, cpu.stat
+    :param path: cgroup目录
+    :param name: 文件名
+    :return: dict, 如 {'anon': 4096, 'file': 0}; 无法读取时返回None
+    """
+    stat = {}
+    try:
+        with open(os.path.join(path, name)) as f:
+            for line in f:
+                key, _, value = line.partition(' ')
+                stat[key] = int(value)
+    except (IOError, OSError, ValueError):
+        return None
+    return stat
+
+
+def read_uptime():
+    """
+    系统启动时长(秒)
+    :return:
+    """
+    with open('/proc/uptime') as f:
+        return float(f.read().split()[0])
+
+
+def iter_proc_stats():
+    """
+    遍历 /proc 下所有进程的 stat 信息
+    :return:
+    """
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        stat = read_proc_stat(name)
+        if stat:
+            yield stat
+
+
+class CpuSampler(object):
+    """
+    根据两次采样之间的jiffies差值计算CPU使用率
+    """
+
+    def __init__(self, max_age=600):
+        """
+        :param max_age: 超过该时间(秒)未再次采样的记录会被清理
+        """
+        self.samples = {}
+        self.max_age = max_age
+        self.last_prune = time.time()
+        self.lock = threading.Lock()
+
+    def percent(self, stat, key=None, now=None):
+        """
+        计算CPU使用率
+        :param stat: ProcStat
+        :param key: 采样者标识, 不同采样者之间的采样互不影响
+        :param now: 采样时间, 默认为当前时间
+        :return: 百分比
+        """
+        now = now or time.time()
+        sample_key = (key, stat.pid)
+        with self.lock:
+            prev = self.samples.get(sample_key)
+            self.samples[sample_key] = (stat.start_time, stat.cpu_time, now)
+            if now - self.last_prune > self.max_age:
+                self.samples = dict((k, v) for k, v in iteritems(self.samples) if now - v[2] <= self.max_age)
+                self.last_prune = now
+
+        # start_time 不同说明 pid 已被其他进程复用
+        if prev and prev[0] == stat.start_time and now > prev[2]:
+            return round((stat.cpu_time - prev[1]) / float(CLK_TCK) / (now - prev[2]) * 100, 1)
+
+        # 首次采样, 与 ps 一样按进程的生命周期计算平均值
+        elapsed = read_uptime() - stat.start_time / float(CLK_TCK)
+        if elapsed <= 0:
+            return 0.0
+        return round(stat.cpu_time / float(CLK_TCK) / elapsed * 100, 1)
+
+
+cpu_sampler = CpuSampler()
+
+
+class RateSampler(object):
+    """
+    根据两次采样的差值计算每秒的速率, 如磁盘读写速率
+    """
+
+    def __init__(self):
+        self.samples = {}
+        self.lock = threading.Lock()
+
+    def rate(self, key, pid, value):
+        """
+        计算速率
+        :param key: 采样者标识
+        :param pid: pid变化时重新采样
+        :param value: 累计值
+        :return: 每秒速率, 首次采样返回None
+        """
+        now = time.time()
+        with self.lock:
+            prev = self.samples.get(key)
+            self.samples[key] = (pid, value, now)
+        if prev is None or prev[0] != pid or value < prev[1] or now <= prev[2]:
+            return None
+        return (value - prev[1]) / (now - prev[2])
+
+    def remove(self, program):
+        """
+        删除程序及其各个检查(program#序号)的采样
+        :param program:
+        :return:
+        """
+        with self.lock:
+            for key in [k for k in self.samples if k == program or k.startswith(program + '#')]:
+                self.samples.pop(key)
+
+
+class ProbeWindow(object):
+    """
+    最近size次检查结果和耗时的环形缓冲区, 基于array, 记录时不分配新对象
+    """
+
+    def __init__(self, size):
+        """
+        :param size: 窗口大小
+        """
+        self.size = size
+        self.outcomes = array.array('b', [0] * size)
+        self.latencies = array.array('d', [0.0] * size)
+        self.index = 0
+        self.count = 0
+        self.failures = 0
+
+    def add(self, failed, latency):
+        """
+        记录一次检查结果, 覆盖最早的记录
+        :param failed: 是否失败
+        :param latency: 检查耗时(秒)
+        :return:
+        """
+        i = self.index
+        if self.count == self.size:
+            self.failures -= self.outcomes[i]
+        else:
+            self.count += 1
+        self.outcomes[i] = 1 if failed else 0
+        self.latencies[i] = latency
+        self.failures += self.outcomes[i]
+        self.index = (i + 1) % self.size
+
+    def percentile(self, p):
+        """
+        窗口内耗时的百分位数, 需要排序一份耗时的拷贝, 只在需要判定时调用
+        :param p: 百分位, 如95
+        :return:
+        """
+        if not self.count:
+            return 0.0
+        values = sorted(self.latencies if self.count == self.size else self.latencies[:self.count])
+        return values[max(int(math.ceil(p / 100.0 * self.count)) - 1, 0)]
+
+
+class ProcSnapshot(object):
+    """
+    某一时刻的进程表, 包含pid索引和父进程到子进程的映射
+    """
+
+    def __init__(self, stats):
+        """
+        :param stats: ProcStat 列表
+        """
+        self.time = time.time()
+        self.procs = {}
+        for stat in stats:
+            self.procs[stat.pid] = stat
+        self.children = build_children(self.procs.values())
+        self.cmdlines = None
+        self.matches = {}
+        self.lock = threading.Lock()
+
+    def get(self, pid):
+        """
+        :param pid:
+        :return: ProcStat, 没有此pid时返回None
+        """
+        try:
+            return self.procs.get(int(pid))
+        except ValueError:
+            return None
+
+    def find(self, pattern, match='contains'):
+        """
+        按命令行查找进程, 同一快照内首次查找时读取所有进程的cmdline, 相同的查找直接返回缓存结果
+        :param pattern:
+        :param match: 匹配方式: exact(完全相同),prefix(前缀),regex(正则),contains(包含)
+        :return: 匹配的pid列表, 从小到大排序
+        """
+        key = (pattern, match)
+        with self.lock:
+            if key in self.matches:
+                return self.matches[key]
+            if self.cmdlines is None:
+                self.cmdlines = {}
+                own_pid = os.getpid()
+                for pid in self.procs:
+                    cmdline = read_proc_cmdline(pid)
+                    if cmdline and pid != own_pid:
+                        self.cmdlines.setdefault(cmdline, []).append(pid)
+
+            if match == 'exact':
+                pids = list(self.cmdlines.get(pattern, []))
+            else:
+                if match == 'prefix':
+                    test = lambda c: c.startswith(pattern)
+                elif match == 'regex':
+                    test = re.compile(pattern).search
+                else:
+                    test = lambda c: pattern in c
+                pids = []
+                for cmdline, cmd_pids in iteritems(self.cmdlines):
+                    if test(cmdline):
+                        pids.extend(cmd_pids)
+            pids.sort()
+            self.matches[key] = pids
+            return pids
+
+    def tree(self, pid, cumulative=True):
+        """
+        获取进程及其所有子孙进程
+        :param pid:
+        :param cumulative: 为False时只返回进程本身
+        :return: ProcStat列表, 第一个为进程本身; 没有此pid时返回空列表
+        """
+        stat = self.get(pid)
+        if stat is None:
+            return []
+        if not cumulative:
+            return [stat]
+        return [stat] + find_children(stat.pid, self.children)
+
+    def mem(self, pid, cumulative=False, mem_type='rss'):
+        """
+        获取进程内存使用及每个进程的明细
+        :param pid: pid或pid列表, 为列表时合计所有进程, 同一进程只统计一次
+        :param cumulative: 是否统计子进程
+        :param mem_type: rss,pss,uss
+        :return: (总内存, [(pid, 内存), ...]), 单位KB, 明细中每个pid排在其子进程之前; 没有此pid时返回(None, [])
+        """
+        usage = []
+        seen = set()
+        for p in (pid if isinstance(pid, list) else [pid]):
+            part = []
+            for stat in self.tree(p, cumulative):
+                if stat.pid in seen:
+                    continue
+                seen.add(stat.pid)
+                mem = read_proc_mem(stat.pid, mem_type, stat.rss if mem_type == 'rss' else None)
+                if mem is not None:
+                    part.append((stat.pid, mem))
+                elif stat.pid == p:
+                    # 进程本身无法读取
+                    break
+            usage.extend(part)
+        if not usage:
+            return None, []
+        return sum([m for _, m in usage]), usage
+
+    def rss(self, pid, cumulative=False):
+        """
+        获取进程内存使用
+        :param pid:
+        :param cumulative: 是否统计子进程
+        :return: 单位MB, 没有此pid时返回None
+        """
+        rss, _ = self.mem(pid, cumulative)
+        if rss is None:
+            return None
+        return rss / 1024  # rss 的单位是 KB， 这里返回MB单位
+
+    def cpu(self, pid, key=None):
+        """
+        获取进程CPU使用率
+        :param pid: pid或pid列表, 为列表时合计所有进程
+        :param key: 采样者标识
+        :return: 没有此pid时返回None
+        """
+        total = None
+        for p in (pid if isinstance(pid, list) else [pid]):
+            stat = self.get(p)
+            if stat is not None:
+                total = (total or 0) + cpu_sampler.percent(stat, key, self.time)
+        if total is None:
+            return None
+        return round(total, 1)
+
+
+class ProcTable(object):
+    """
+    进程表缓存, ttl时间内的mem,cpu检查共用同一份快照, 每个周期只扫描一次/proc
+    """
+
+    def __init__(self, ttl=1):
+        """
+        :param ttl: 快照有效时间(秒)
+        """
+        self.ttl = ttl
+        self.snapshot = None
+        self.lock = threading.Lock()
+
+    def get(self):
+        """
+        获取快照, 过期后重新扫描/proc
+        :return: ProcSnapshot
+        """
+        with self.lock:
+            if self.snapshot is None or time.time() - self.snapshot.time >= self.ttl:
+                self.snapshot = ProcSnapshot(iter_proc_stats())
+            return self.snapshot
+
+    def invalidate(self):
+        """
+        使快照失效, 进程变化后调用
+        :return:
+        """
+        with self.lock:
+            self.snapshot = None
+
+
+def get_proc_cpu(pid, key=None):
+    """
+    获取进程CPU使用率, 第二次采样开始为两次采样间隔内的使用率
+    :param pid:
+    :param key: 采样者标识
+    :return:
     """
-    获取进程CPU使用率
+    if not HAS_PROCFS:
+        return get_proc_cpu_ps(pid)
+
+    stat = read_proc_stat(pid)
+    if stat is None:
+        # 没有此pid信息
+        return None
+    return cpu_sampler.percent(stat, key)
+
+
+def get_proc_rss(pid, cumulative=False):
+    """
+    获取进程内存使用
+    :param pid:
+    :param cumulative:
+    :return:
+    """
+    if not HAS_PROCFS:
+        return get_proc_rss_ps(pid, cumulative)
+
+    if cumulative:
+        # 统计进程的子进程rss
+        try:
+            rss = tree_rss(list(iter_proc_stats()), int(pid))
+        except ValueError:
+            rss = None
+        if rss is None:
+            # 计算错误时，返回None
+            return None
+
+    else:
+        rss = read_proc_statm(pid)
+        if rss is None:
+            # 没有此pid信息
+            return None
+
+    rss = rss / 1024  # rss 的单位是 KB， 这里返回MB单位
+    return rss
+
+
+def get_proc_cpu_ps(pid):
+    """
+    通过ps获取进程CPU使用率, 用于没有/proc的系统
     :param pid:
     :return:
     """
@@ -89,26 +718,15 @@ def get_proc_cpu(pid):
     return cpu_utilization
 
 
-def get_proc_rss(pid, cumulative=False):
+def get_proc_rss_ps(pid, cumulative=False):
     """
-    获取进程内存使用
+    通过ps获取进程内存使用, 用于没有/proc的系统
     :param pid:
     :param cumulative:
     :return:
     """
     pscommand = 'ps -orss= -p %s'
     pstreecommand = 'ps ax -o "pid= ppid= rss="'
-    ProcInfo = namedtuple('ProcInfo', ['pid', 'ppid', 'rss'])
-
-    def find_children(parent_pid, procs):
-        # 找出进程的子进程信息
-        children = []
-        for proc in procs:
-            pid, ppid, rss = proc
-            if ppid == parent_pid:
-                children.append(proc)
-                children.extend(find_children(pid, procs))
-        return children
 
     if cumulative:
         # 统计进程的子进程rss
@@ -122,11 +740,10 @@ def get_proc_rss(pid, cumulative=False):
 
         # 计算rss
         try:
-            parent_proc = [p for p in procs if p.pid == pid][0]
-            children = find_children(pid, procs)
-            tree = [parent_proc] + children
-            rss = sum(map(int, [p.rss for p in tree]))
-        except (ValueError, IndexError):
+            rss = tree_rss(procs, int(pid))
+        except ValueError:
+            rss = None
+        if rss is None:
             # 计算错误时，返回None
             return None
 
@@ -142,20 +759,1275 @@ def get_proc_rss(pid, cumulative=False):
             # 获取的结果不包含数据，或者无法识别rss
             return None
 
-    rss = rss / 1024  # rss 的单位是 KB， 这里返回MB单位
-    return rss
+    rss = rss / 1024  # rss 的单位是 KB， 这里返回MB单位
+    return rss
+
+
+def parse_status_ranges(spec):
+    """
+    解析期望的http状态码
+    :param spec: 如 200, '200-299,301', [200, '300-399']
+    :return: [(low, high), ...]
+    """
+    if not isinstance(spec, (list, tuple)):
+        spec = str(spec).split(',')
+    ranges = []
+    for item in spec:
+        item = str(item).strip()
+        if not item:
+            continue
+        low, _, high = item.partition('-')
+        ranges.append((int(low), int(high or low)))
+    return ranges
+
+
+def json_path_get(data, path):
+    """
+    按路径获取json中的值
+    :param data:
+    :param path: 以.分隔的路径, 如 $.data.items.0.status
+    :return:
+    :raise: KeyError, IndexError, TypeError, ValueError 路径不存在时
+    """
+    for key in path.split('.'):
+        if key in ('', '$'):
+            continue
+        if isinstance(data, list):
+            data = data[int(key)]
+        else:
+            data = data[key]
+    return data
+
+
+class Scheduler(object):
+    """
+    基于最小堆的调度器, 所有检测任务共用一个调度线程, 由固定数量的工作线程执行
+    """
+
+    def __init__(self, max_workers=10):
+        """
+        :param max_workers: 同时执行的检测任务上限
+        """
+        self.max_workers = max_workers
+        self.heap = []
+        self.jobs = {}
+        # 执行中的任务名称, 以及执行期间被替换或要求立即执行的任务的下一次执行时间
+        self.running = set()
+        self.deferred = {}
+        self.seq = 0
+        self.cond = threading.Condition()
+        self.tasks = queue.Queue()
+
+    def _push(self, name, job, deadline):
+        # seq 保证相同 deadline 时按加入顺序执行, 且不会去比较 job
+        self.seq += 1
+        heapq.heappush(self.heap, (deadline, self.seq, name, job))
+
+    def _schedule(self, name, job, deadline):
+        # 同名任务执行中时只记录下一次执行时间, 执行结束后再调度, 保证同名任务不会同时执行
+        if name in self.running:
+            self.deferred[name] = min(deadline, self.deferred.get(name, deadline))
+        else:
+            self._push(name, job, deadline)
+            self.cond.notify()
+
+    def add(self, name, func, period, delay=0):
+        """
+        添加任务, 同名任务会被替换
+        :param name:
+        :param func:
+        :param period: 执行间隔(秒)
+        :param delay: 首次执行等待时间(秒)
+        :return:
+        """
+        job = {'func': func, 'period': period}
+        with self.cond:
+            self.jobs[name] = job
+            self._schedule(name, job, time.time() + delay)
+
+    def remove(self, name):
+        """
+        移除任务, 堆中残留的条目在到期时被丢弃
+        :param name:
+        :return:
+        """
+        with self.cond:
+            self.jobs.pop(name, None)
+            self.deferred.pop(name, None)
+
+    def trigger(self, name):
+        """
+        立即执行任务, 之后按原 period 继续调度, 任务执行中时在本次执行结束后立即再执行
+        :param name:
+        :return:
+        """
+        with self.cond:
+            job = self.jobs.get(name)
+            if job is None:
+                return
+            # 替换为新的任务对象, 堆中的旧条目不会再被调度
+            job = dict(job)
+            self.jobs[name] = job
+            self._schedule(name, job, time.time())
+
+    def worker(self):
+        """
+        工作线程, 执行完成后按 period 计算下一次执行时间, 任务返回数字时作为本次的间隔
+        :return:
+        """
+        while 1:
+            name, job = self.tasks.get()
+            start = time.time()
+            period = job['period']
+            try:
+                result = job['func']()
+                if isinstance(result, (int, float)) and not isinstance(result, bool) and result > 0:
+                    period = result
+            except Exception as e:
+                sys.stderr.write('[scheduler] job %s error: %s\n' % (name, e))
+                sys.stderr.flush()
+            with self.cond:
+                self.running.discard(name)
+                current = self.jobs.get(name)
+                if name in self.deferred:
+                    deadline = self.deferred.pop(name)
+                    if current is not None:
+                        self._push(name, current, max(deadline, time.time()))
+                        self.cond.notify()
+                elif current is job:
+                    self._push(name, job, max(start + period, time.time()))
+                    self.cond.notify()
+
+    def run(self):
+        """
+        调度主循环, 休眠到最早的 deadline 后把任务交给工作线程
+        :return:
+        """
+        for _ in range(self.max_workers):
+            t = threading.Thread(target=self.worker)
+            t.setDaemon(True)
+            t.start()
+
+        while 1:
+            with self.cond:
+                now = time.time()
+                while self.heap and self.heap[0][0] <= now:
+                    _, _, name, job = heapq.heappop(self.heap)
+                    if self.jobs.get(name) is job and name not in self.running:
+                        self.running.add(name)
+                        self.tasks.put((name, job))
+                # python2 中无超时的 wait 不能被信号中断, 所以最多等待1秒
+                timeout = 1
+                if self.heap:
+                    timeout = min(max(self.heap[0][0] - now, 0), 1)
+                self.cond.wait(timeout)
+
+
+class SupervisorState(object):
+    """
+    supervisor进程信息缓存, 每个周期只调用一次getAllProcessInfo, 所有程序共用结果和同一个连接
+    """
+
+    def __init__(self, connect, ttl=1):
+        """
+        :param connect: 创建supervisor连接的函数
+        :param ttl: 缓存有效时间(秒)
+        """
+        self.connect = connect
+        self.ttl = ttl
+        self.conn = None
+        self.infos = {}
+        self.processes = []
+        self.time = 0
+        self.refreshing = False
+        self.error = None
+        self.error_time = 0
+        self.conn_lock = threading.Lock()
+        self.cache_lock = threading.Condition()
+
+    def call(self, method, *args):
+        """
+        通过持久连接调用supervisor的rpc接口, 连接异常时重连一次
+        :param method: supervisor命名空间下的方法名
+        :param args:
+        :return:
+        """
+        with self.conn_lock:
+            for retry in (True, False):
+                if self.conn is None:
+                    self.conn = self.connect()
+                try:
+                    return getattr(self.conn.supervisor, method)(*args)
+                except Fault:
+                    raise
+                except Exception:
+                    self.conn = None
+                    if not retry:
+                        raise
+
+    def get(self, program):
+        """
+        获取进程信息, 缓存过期后重新调用getAllProcessInfo
+        :param program: 进程名称, 支持 name 和 group:name
+        :return: dict, 没有此进程时返回None
+        """
+        self._refresh()
+        with self.cache_lock:
+            return self.infos.get(program)
+
+    def all(self):
+        """
+        获取所有进程信息
+        :return: getAllProcessInfo的结果
+        """
+        self._refresh()
+        with self.cache_lock:
+            return self.processes
+
+    def _refresh(self):
+        """
+        缓存过期时由一个线程调用getAllProcessInfo, 调用期间不持有 cache_lock,
+        其他线程有旧数据时直接使用旧数据, 没有时等待本次调用结束; 调用失败后ttl内直接返回同样的错误
+        :return:
+        """
+        with self.cache_lock:
+            while 1:
+                if time.time() - self.time < self.ttl:
+                    return
+                if not self.refreshing:
+                    break
+                if self.time:
+                    return
+                # python2 中无超时的 wait 不能被信号中断
+                self.cache_lock.wait(1)
+            if self.error is not None and time.time() - self.error_time < self.ttl:
+                raise self.error
+            self.refreshing = True
+
+        try:
+            processes = self.call('getAllProcessInfo')
+        except Exception as e:
+            with self.cache_lock:
+                self.refreshing = False
+                self.error = e
+                self.error_time = time.time()
+                self.cache_lock.notify_all()
+            raise
+
+        infos = {}
+        for info in processes:
+            infos[info['name']] = info
+            infos['%s:%s' % (info['group'], info['name'])] = info
+        with self.cache_lock:
+            self.infos = infos
+            self.processes = processes
+            self.time = time.time()
+            self.refreshing = False
+            self.error = None
+            self.cache_lock.notify_all()
+
+    def invalidate(self):
+        """
+        使缓存失效, 进程状态变更后调用
+        :return:
+        """
+        with self.cache_lock:
+            self.time = 0
+
+
+class HTTPConnectionPool(object):
+    """
+    按 (host, port) 复用的http长连接池
+    """
+
+    def __init__(self, max_idle=2):
+        """
+        :param max_idle: 每个 (host, port) 最多保留的空闲连接数
+        """
+        self.max_idle = max_idle
+        self.idle = {}
+        self.lock = threading.Lock()
+
+    def get(self, host, port, timeout):
+        """
+        获取连接, 没有空闲连接时新建
+        :param host:
+        :param port:
+        :param timeout:
+        :return: (conn, reused)
+        """
+        with self.lock:
+            conns = self.idle.get((host, port))
+            conn = conns.pop() if conns else None
+        if conn is None:
+            return httplib.HTTPConnection(host, port, timeout=timeout), False
+        conn.timeout = timeout
+        if conn.sock:
+            conn.sock.settimeout(timeout)
+        return conn, True
+
+    def put(self, host, port, conn):
+        """
+        归还连接, 超过空闲上限时关闭
+        :param host:
+        :param port:
+        :param conn:
+        :return:
+        """
+        with self.lock:
+            conns = self.idle.setdefault((host, port), [])
+            if len(conns) < self.max_idle:
+                conns.append(conn)
+                return
+        conn.close()
+
+
+def to_bytes(s):
+    """
+    转为bytes
+    :param s:
+    :return:
+    """
+    if isinstance(s, bytes):
+        return s
+    return s.encode('utf-8')
+
+
+class TcpProber(object):
+    """
+    非阻塞的TCP检测引擎, 由一个线程多路复用所有检测连接, 每个连接有独立的超时时间
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = []
+        self.probes = {}
+        self.thread = None
+        self.wakeup_r, self.wakeup_w = os.pipe()
+
+    def probe(self, host, port, timeout, send=None, expect=None, read_bytes=1024):
+        """
+        提交一次检测并等待结果
+        :param host:
+        :param port:
+        :param timeout: 超时时间(秒), 包含连接、发送和接收
+        :param send: 连接后发送的数据
+        :param expect: 期望在响应中出现的数据
+        :param read_bytes: 最多读取的字节数
+        :return: dict, error为空表示成功, connect和total为耗时(秒), data为读取到的数据
+        """
+        probe = {'error': '', 'connect': 0, 'total': 0, 'data': b'',
+                 'send': to_bytes(send) if send else b'', 'expect': to_bytes(expect) if expect else b'',
+                 'read_bytes': read_bytes, 'event': threading.Event(), 'start': time.time()}
+        probe['deadline'] = probe['start'] + timeout
+        try:
+            family, socktype, proto, _, addr = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)[0]
+            sock = socket.socket(family, socktype, proto)
+            sock.setblocking(0)
+            err = sock.connect_ex(addr)
+            if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY):
+                sock.close()
+                raise socket.error(err, os.strerror(err))
+        except Exception as e:
+            probe['error'] = str(e)
+            return probe
+
+        probe['sock'] = sock
+        probe['state'] = 'connect'
+        with self.lock:
+            self.pending.append(probe)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run)
+                self.thread.setDaemon(True)
+                self.thread.start()
+        os.write(self.wakeup_w, b'x')
+        probe['event'].wait(timeout + 1)
+        return probe
+
+    def finish(self, probe, error=''):
+        """
+        结束检测, 关闭连接并唤醒等待的线程
+        :param probe:
+        :param error:
+        :return:
+        """
+        self.probes.pop(probe['sock'].fileno(), None)
+        probe['sock'].close()
+        probe['error'] = error
+        probe['total'] = time.time() - probe['start']
+        probe['event'].set()
+
+    def handle(self, probe):
+        """
+        连接可读或可写时推进检测状态: connect -> send -> recv
+        :param probe:
+        :return:
+        """
+        sock = probe['sock']
+        try:
+            if probe['state'] == 'connect':
+                err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if err:
+                    return self.finish(probe, os.strerror(err))
+                probe['connect'] = time.time() - probe['start']
+                probe['state'] = 'send' if probe['send'] else 'recv'
+            elif probe['state'] == 'send':
+                sent = sock.send(probe['send'])
+                probe['send'] = probe['send'][sent:]
+                if not probe['send']:
+                    probe['state'] = 'recv'
+            elif probe['state'] == 'recv':
+                data = sock.recv(probe['read_bytes'] - len(probe['data']))
+                probe['data'] += data
+                if probe['expect'] in probe['data']:
+                    return self.finish(probe)
+                if not data or len(probe['data']) >= probe['read_bytes']:
+                    return self.finish(probe, 'expect %r, got %r' % (probe['expect'], probe['data']))
+
+            if probe['state'] == 'recv' and not probe['expect']:
+                self.finish(probe)
+        except socket.error as e:
+            if e.args and e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            self.finish(probe, str(e))
+
+    def wait(self, timeout):
+        """
+        等待连接可读或可写
+        :param timeout:
+        :return: 就绪的fd列表
+        """
+        readers = [fd for fd, p in iteritems(self.probes) if p['state'] == 'recv']
+        writers = [fd for fd, p in iteritems(self.probes) if p['state'] != 'recv']
+        if hasattr(select, 'poll'):
+            poller = select.poll()
+            poller.register(self.wakeup_r, select.POLLIN)
+            for fd in readers:
+                poller.register(fd, select.POLLIN)
+            for fd in writers:
+                poller.register(fd, select.POLLOUT)
+            return [fd for fd, _ in poller.poll(timeout * 1000)]
+        r, w, _ = select.select(readers + [self.wakeup_r], writers, [], timeout)
+        return r + w
+
+    def run(self):
+        """
+        引擎主循环
+        :return:
+        """
+        while 1:
+            with self.lock:
+                for probe in self.pending:
+                    self.probes[probe['sock'].fileno()] = probe
+                self.pending = []
+
+            now = time.time()
+            for probe in list(self.probes.values()):
+                if probe['deadline'] <= now:
+                    self.finish(probe, 'timed out in %s' % probe['state'])
+            timeout = 1
+            if self.probes:
+                timeout = min(max(min([p['deadline'] for p in self.probes.values()]) - now, 0), 1)
+
+            try:
+                ready = self.wait(timeout)
+            except (select.error, OSError) as e:
+                if e.args and e.args[0] == errno.EINTR:
+                    continue
+                raise
+            for fd in ready:
+                if fd == self.wakeup_r:
+                    os.read(self.wakeup_r, 4096)
+                elif fd in self.probes:
+                    self.handle(self.probes[fd])
+
+
+class HostIdentity(object):
+    """
+    本机标识(ip, 主机名, 系统信息), 启动时计算一次, 通知时直接使用;
+    定时对比 /proc/net 下的路由和地址信息, 网络变化时重新计算
+    """
+
+    fingerprint_files = ('/proc/net/route', '/proc/net/if_inet6')
+
+    def __init__(self):
+        self.fingerprint = None
+        self.info = {'ip': '', 'hostname': '', 'platform': ''}
+        self.refresh()
+
+    def get_fingerprint(self):
+        """
+        获取路由和接口地址信息, 网络变化时内容会改变
+        :return:
+        """
+        data = []
+        for path in self.fingerprint_files:
+            try:
+                with open(path) as f:
+                    data.append(f.read())
+            except (IOError, OSError):
+                continue
+        return '\n'.join(data)
+
+    def get_ip(self):
+        """
+        获取本机出口ip, 通过UDP连接让系统选择路由, 不会真正发送数据; 没有默认路由时使用主机名解析
+        :return:
+        """
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            s.connect(('8.8.8.8', 80))
+            return s.getsockname()[0]
+        except socket.error:
+            pass
+        finally:
+            s.close()
+        try:
+            return socket.gethostbyname(socket.gethostname())
+        except socket.error:
+            return ''
+
+    def refresh(self):
+        """
+        网络信息变化时重新计算本机标识
+        :return: 是否重新计算
+        """
+        fingerprint = self.get_fingerprint()
+        if self.fingerprint is not None and fingerprint == self.fingerprint:
+            return False
+        self.fingerprint = fingerprint
+        self.info = {
+            'ip': self.get_ip(),
+            'hostname': platform.node().split('.')[0],
+            'platform': platform.platform()
+        }
+        return True
+
+
+class MailSession(object):
+    """
+    保持登录状态的SMTP会话, 定时NOOP保活, 连接断开时重连
+    """
+
+    def __init__(self, host, port, user, password, to_list, timeout=10, idle_seconds=600):
+        """
+        :param host:
+        :param port:
+        :param user:
+        :param password:
+        :param to_list: 收件人列表
+        :param timeout: 连接超时时间(秒)
+        :param idle_seconds: 超过该时间(秒)没有发送邮件时关闭连接
+        """
+        self.host = host
+        self.port = port
+        self.user = user
+        self.password = password
+        self.to_list = to_list
+        self.timeout = timeout
+        self.idle_seconds = idle_seconds
+        self.smtp = None
+        self.last_used = 0
+        self.lock = threading.Lock()
+
+    def close(self):
+        """
+        关闭连接, 忽略关闭时的错误
+        :return:
+        """
+        if self.smtp is not None:
+            try:
+                self.smtp.quit()
+            except (smtplib.SMTPException, socket.error):
+                pass
+            self.smtp = None
+
+    def send(self, subject, content):
+        """
+        发送邮件, 复用已登录的连接, 连接断开时重连一次
+        :param subject:
+        :param content:
+        :return:
+        :raise: smtplib.SMTPException, socket.error
+        """
+        msg = MIMEText(content, _subtype='plain', _charset='utf-8')
+        msg['Subject'] = Header(subject, 'utf-8')
+        msg['From'] = self.user
+        msg['to'] = ",".join(self.to_list)
+        with self.lock:
+            for retry in (True, False):
+                try:
+                    if self.smtp is None:
+                        smtp = smtplib.SMTP_SSL(self.host, self.port, timeout=self.timeout)
+                        try:
+                            smtp.login(self.user, self.password)
+                        except Exception:
+                            # 登录失败的连接不保留, 否则之后的邮件都会因未登录而失败
+                            smtp.close()
+                            raise
+                        self.smtp = smtp
+                    self.smtp.sendmail(self.user, self.to_list, msg.as_string())
+                    self.last_used = time.time()
+                    return
+                except (smtplib.SMTPServerDisconnected, socket.error):
+                    self.close()
+                    if not retry:
+                        raise
+                except smtplib.SMTPException:
+                    # python2 中 SMTPException 不是 socket.error 的子类, 会话状态未知时重新建立连接
+                    self.close()
+                    raise
+
+    def keepalive(self):
+        """
+        定时调用: 空闲过久时关闭连接, 否则发送NOOP保持连接
+        :return:
+        """
+        with self.lock:
+            if self.smtp is None:
+                return
+            if time.time() - self.last_used > self.idle_seconds:
+                self.close()
+                return
+            try:
+                if self.smtp.noop()[0] != 250:
+                    self.close()
+            except (smtplib.SMTPException, socket.error):
+                self.close()
+
+
+class MailDigest(object):
+    """
+    窗口期内的邮件合并为一封摘要邮件发送, 发送失败时邮件放回摘要, 按指数退避重试
+    """
+
+    def __init__(self, session, window, log, retries=3, retry_seconds=2):
+        """
+        :param session: MailSession
+        :param window: 合并窗口(秒), 从窗口内第一封邮件开始计时
+        :param log: 日志函数
+        :param retries: 发送失败后的重试次数
+        :param retry_seconds: 首次重试的等待时间(秒), 之后每次翻倍
+        """
+        self.session = session
+        self.window = window
+        self.log = log
+        self.retries = retries
+        self.retry_seconds = retry_seconds
+        self.attempt = 0
+        self.items = []
+        self.timer = None
+        self.lock = threading.Lock()
+
+    def add(self, subject, content):
+        """
+        加入摘要, 窗口结束后统一发送
+        :param subject:
+        :param content:
+        :return:
+        """
+        with self.lock:
+            self.items.append((subject, content))
+            if self.timer is None:
+                self.start_timer(self.window)
+
+    def start_timer(self, delay):
+        """
+        启动发送定时器, 调用时需持有锁
+        :param delay: 等待时间(秒)
+        :return:
+        """
+        self.timer = threading.Timer(delay, self.flush)
+        self.timer.setDaemon(True)
+        self.timer.start()
+
+    def flush(self):
+        """
+        发送摘要邮件
+        :return:
+        """
+        with self.lock:
+            items = self.items
+            self.items = []
+            self.timer = None
+        if not items:
+            return
+
+        if len(items) == 1:
+            subject, content = items[0]
+        else:
+            subject = "[Supervisor] %s health check notices" % len(items)
+            content = '\n'.join(['%s\n%s' % item for item in items])
+        try:
+            self.session.send(subject, content)
+        except Exception as e:
+            self.log('healthCheck:', 'Action: email digest send error %s' % e)
+            with self.lock:
+                if self.attempt >= self.retries:
+                    self.attempt = 0
+                    self.log('healthCheck:', 'Action: email digest of %s notices dropped after %s retries.',
+                             len(items), self.retries)
+                    return
+                # 放回摘要, 与重试前新加入的邮件一起发送
+                self.items = items + self.items
+                delay = self.retry_seconds * 2 ** self.attempt
+                self.attempt += 1
+                if self.timer is None:
+                    self.start_timer(delay)
+            self.log('healthCheck:', 'Action: email digest retry in %ss', delay)
+            return
+        with self.lock:
+            self.attempt = 0
+        self.log('healthCheck:', 'Action: email digest of %s notices send success.', len(items))
+
+
+class WechatClient(object):
+    """
+    企业微信接口客户端, 缓存access_token并复用到接口的https连接
+    """
+
+    host = 'qyapi.weixin.qq.com'
+    # access_token 过期或无效的错误码
+    token_errcodes = (40014, 42001)
+
+    def __init__(self, corpid, secret, timeout=10, refresh_margin=300):
+        """
+        :param corpid:
+        :param secret:
+        :param timeout: 接口超时时间(秒)
+        :param refresh_margin: 在access_token过期前多少秒主动刷新
+        """
+        self.corpid = corpid
+        self.secret = secret
+        self.timeout = timeout
+        self.refresh_margin = refresh_margin
+        self.token = None
+        self.expires_at = 0
+        self.conn = None
+        self.conn_lock = threading.Lock()
+        self.token_lock = threading.Lock()
+
+    def request(self, method, url, body=None):
+        """
+        通过持久连接请求接口, 连接异常时重连一次
+        :param method:
+        :param url:
+        :param body:
+        :return: 接口返回的json
+        """
+        headers = {'Content-Type': 'application/json'}
+        with self.conn_lock:
+            for retry in (True, False):
+                if self.conn is None:
+                    self.conn = httplib.HTTPSConnection(self.host, timeout=self.timeout)
+                try:
+                    self.conn.request(method, url, body, headers=headers)
+                    return json.loads(self.conn.getresponse().read())
+                except (httplib.HTTPException, socket.error):
+                    self.conn.close()
+                    self.conn = None
+                    if not retry:
+                        raise
+
+    def get_token(self, force=False):
+        """
+        获取access_token, 快过期时重新获取
+        :param force: 强制重新获取
+        :return:
+        """
+        with self.token_lock:
+            if force or not self.token or time.time() >= self.expires_at - self.refresh_margin:
+                url = '/cgi-bin/gettoken?corpid={id}&corpsecret={crt}'.format(id=self.corpid, crt=self.secret)
+                result = self.request('GET', url)
+                if result.get('errcode', 0) != 0:
+                    raise ValueError('get token faild %s' % result)
+                self.token = result['access_token']
+                self.expires_at = time.time() + int(result.get('expires_in', 7200))
+            return self.token
+
+    def send(self, data):
+        """
+        发送应用消息, access_token失效时刷新后重试一次
+        :param data:
+        :return: 接口返回的json
+        """
+        result = {}
+        for force in (False, True):
+            send_url = '/cgi-bin/message/send?access_token={token}'.format(token=self.get_token(force))
+            result = self.request('POST', send_url, json.dumps(data))
+            if result.get('errcode') not in self.token_errcodes:
+                break
+        return result
+
+
+class Notifier(object):
+    """
+    异步通知分发: 每个通道有独立的有界队列和工作线程, 失败后按指数退避重试,
+    窗口期内同一程序的状态与上一次发送的相同时只发送一次, 其余的合并计数到下一次通知中
+    """
+
+    def __init__(self, log, queue_size=100, retries=3, retry_seconds=2, dedup_seconds=60):
+        """
+        :param log: 日志函数, 参数同 HealthCheck.log
+        :param queue_size: 每个通道的队列长度, 队列满时丢弃新通知
+        :param retries: 发送失败后的重试次数
+        :param retry_seconds: 首次重试的等待时间(秒), 之后每次翻倍
+        :param dedup_seconds: 去重窗口(秒)
+        """
+        self.log = log
+        self.queue_size = queue_size
+        self.retries = retries
+        self.retry_seconds = retry_seconds
+        self.dedup_seconds = dedup_seconds
+        self.channels = {}
+        self.recent = {}
+        self.lock = threading.Lock()
+
+    def register(self, channel, func):
+        """
+        注册通知通道并启动工作线程
+        :param channel: 通道名称, 如 email, wechat
+        :param func: 发送函数, 参数为 (program, action_type, msg, check_status), 成功返回True
+        :return:
+        """
+        tasks = queue.Queue(self.queue_size)
+        self.channels[channel] = (func, tasks)
+        t = threading.Thread(target=self.worker, args=(channel, func, tasks))
+        t.setDaemon(True)
+        t.start()
+
+    def notify(self, channel, program, action_type, msg, check_status):
+        """
+        提交通知, 立即返回
+        :param channel:
+        :param program:
+        :param action_type:
+        :param msg:
+        :param check_status:
+        :return: 是否已加入队列
+        """
+        if channel not in self.channels:
+            return False
+
+        # 按程序记录上一次发送的状态, 状态变化(如 failure -> resolved -> failure)时总会发送
+        key = (channel, program)
+        now = time.time()
+        with self.lock:
+            last_status, last_time, suppressed = self.recent.get(key, (None, 0, 0))
+            if last_status == check_status and now - last_time < self.dedup_seconds:
+                self.recent[key] = (last_status, last_time, suppressed + 1)
+                self.log(program, 'Action: %s suppressed duplicate notice', channel)
+                return False
+
+            if suppressed:
+                msg = '%s\r\n Suppressed: %s %s notices in the last %ss' % (msg, suppressed, last_status,
+                                                                               self.dedup_seconds)
+            try:
+                self.channels[channel][1].put_nowait((program, action_type, msg, check_status))
+            except queue.Full:
+                # 未加入队列的通知不记录, 重试时不会被当作重复通知
+                self.log(program, 'Action: %s queue is full, drop notice', channel)
+                return False
+            self.recent[key] = (check_status, now, 0)
+        return True
+
+    def worker(self, channel, func, tasks):
+        """
+        通道工作线程, 重试只会阻塞本通道
+        :param channel:
+        :param func:
+        :param tasks:
+        :return:
+        """
+        while 1:
+            program, action_type, msg, check_status = tasks.get()
+            for attempt in range(self.retries + 1):
+                try:
+                    if func(program, action_type, msg, check_status):
+                        break
+                except Exception as e:
+                    self.log(program, 'Action: %s error %s', channel, e)
+                if attempt < self.retries:
+                    delay = self.retry_seconds * 2 ** attempt
+                    self.log(program, 'Action: %s retry in %ss', channel, delay)
+                    time.sleep(delay)
+
+
+class RestartGovernor(object):
+    """
+    重启限流: 并发上限, 令牌桶限速, 单个程序指数退避, 大面积失败时熔断停止重启
+    """
+
+    def __init__(self, max_concurrent=2, rate_per_minute=10, burst=5, backoff_seconds=30, max_backoff_seconds=600,
+                 breaker_ratio=0.5, breaker_min_programs=4):
+        """
+        :param max_concurrent: 同时进行的重启数上限
+        :param rate_per_minute: 令牌桶每分钟补充的令牌数
+        :param burst: 令牌桶容量
+        :param backoff_seconds: 程序重启后, 再次重启的最小间隔(秒), 每次重启后翻倍
+        :param max_backoff_seconds: 退避间隔上限(秒)
+        :param breaker_ratio: 失败程序占比超过该值时熔断
+        :param breaker_min_programs: 检查的程序数少于该值时不熔断
+        """
+        self.semaphore = threading.Semaphore(max_concurrent)
+        self.rate = rate_per_minute / 60.0
+        self.burst = burst
+        self.tokens = float(burst)
+        self.last_refill = time.time()
+        self.backoff_seconds = backoff_seconds
+        self.max_backoff_seconds = max_backoff_seconds
+        self.breaker_ratio = breaker_ratio
+        self.breaker_min_programs = breaker_min_programs
+        self.backoff = {}
+        self.lock = threading.Lock()
+
+    def acquire(self, program, failing, total):
+        """
+        判断是否允许重启, 允许时需在重启结束后调用release
+        :param program:
+        :param failing: 当前失败的程序数
+        :param total: 检查的程序总数
+        :return: 决策: allowed, circuit_open, backoff, rate_limited, concurrency
+        """
+        with self.lock:
+            now = time.time()
+            if total >= self.breaker_min_programs and failing > total * self.breaker_ratio:
+                return 'circuit_open'
+
+            next_allowed, delay = self.backoff.get(program, (0, 0))
+            if now < next_allowed:
+                return 'backoff'
+
+            self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.rate)
+            self.last_refill = now
+            if self.tokens < 1:
+                return 'rate_limited'
+
+            if not self.semaphore.acquire(False):
+                return 'concurrency'
+
+            self.tokens -= 1
+            delay = min(max(delay * 2, self.backoff_seconds), self.max_backoff_seconds)
+            self.backoff[program] = (now + delay, delay)
+        return 'allowed'
+
+    def release(self):
+        """
+        重启结束
+        :return:
+        """
+        self.semaphore.release()
+
+    def reset(self, program):
+        """
+        程序恢复后清除退避
+        :param program:
+        :return:
+        """
+        with self.lock:
+            self.backoff.pop(program, None)
+
+
+class StateJournal(object):
+    """
+    检查状态的追加写日志文件, 每行一条json记录, 启动时回放, 记录过多时压缩为当前状态
+    写入由后台线程批量完成, 检查线程只更新内存中的待写记录
+    """
+
+    def __init__(self, path, flush_seconds=1, compact_records=1000):
+        """
+        :param path: 日志文件路径
+        :param flush_seconds: 批量写入的间隔(秒)
+        :param compact_records: 追加的记录数超过该值且超过程序数的10倍时压缩
+        """
+        self.path = path
+        self.flush_seconds = flush_seconds
+        self.compact_records = compact_records
+        self.states = {}
+        self.pending = {}
+        self.records = 0
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()
+
+    def load(self):
+        """
+        回放日志文件, 并启动后台写入线程
+        :return: {program: state}
+        """
+        try:
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # 异常退出时最后一行可能不完整
+                        continue
+                    if not isinstance(record, dict) or 'program' not in record or not isinstance(
+                            record.get('state') or {}, dict):
+                        continue
+                    if record.get('state') is None:
+                        self.states.pop(record['program'], None)
+                    else:
+                        self.states[record['program']] = record['state']
+                    self.records += 1
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+        t = threading.Thread(target=self.worker)
+        t.setDaemon(True)
+        t.start()
+        atexit.register(self.flush)
+        return dict((program, dict(state)) for program, state in iteritems(self.states))
+
+    def record(self, program, state):
+        """
+        记录程序的最新状态, 同一程序在一个写入间隔内只写最后一次
+        :param program:
+        :param state: 为None时删除该程序的状态
+        :return:
+        """
+        with self.lock:
+            # 深拷贝, 避免写入时检查线程修改嵌套的状态
+            self.pending[program] = json.loads(json.dumps(state)) if state is not None else None
+
+    def flush(self):
+        """
+        写入待写记录, 需要时压缩日志文件
+        :return:
+        """
+        with self.write_lock:
+            with self.lock:
+                pending = self.pending
+                self.pending = {}
+
+            if pending:
+                lines = []
+                for program, state in iteritems(pending):
+                    if state is None:
+                        self.states.pop(program, None)
+                    else:
+                        self.states[program] = state
+                    lines.append(json.dumps({'program': program, 'state': state}) + '\n')
+                with open(self.path, 'a') as f:
+                    f.write(''.join(lines))
+                self.records += len(lines)
+
+            if self.records > max(self.compact_records, len(self.states) * 10):
+                self.compact()
+
+    def compact(self):
+        """
+        把当前状态写入临时文件后替换日志文件
+        :return:
+        """
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            for program, state in iteritems(self.states):
+                f.write(json.dumps({'program': program, 'state': state}) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, self.path)
+        self.records = len(self.states)
+
+    def worker(self):
+        """
+        后台写入线程
+        :return:
+        """
+        while 1:
+            time.sleep(self.flush_seconds)
+            try:
+                self.flush()
+            except Exception as e:
+                sys.stderr.write('[journal] write %s error: %s\n' % (self.path, e))
+                sys.stderr.flush()
+
+
+class Metrics(object):
+    """
+    检查结果指标, 保存在内存中, 以Prometheus文本格式输出, 输出时不会触发检查
+    """
+
+    buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, prefix='supervisor_healthcheck'):
+        """
+        :param prefix: 指标名称前缀
+        """
+        self.prefix = prefix
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def _get(self, name, kind, doc, labels):
+        # 返回 (指标, 标签) 对应的值, 调用前需持有锁
+        metric = self.metrics.setdefault(name, {'kind': kind, 'doc': doc, 'values': {}})
+        return metric['values'], tuple(sorted(iteritems(labels)))
+
+    def inc(self, name, doc, labels, value=1):
+        """
+        计数器增加
+        :param name:
+        :param doc: 指标说明
+        :param labels: dict
+        :param value:
+        :return:
+        """
+        with self.lock:
+            values, key = self._get(name, 'counter', doc, labels)
+            values[key] = values.get(key, 0) + value
+
+    def set(self, name, doc, labels, value):
+        """
+        设置仪表盘的值
+        :param name:
+        :param doc:
+        :param labels:
+        :param value:
+        :return:
+        """
+        with self.lock:
+            values, key = self._get(name, 'gauge', doc, labels)
+            values[key] = value
+
+    def observe(self, name, doc, labels, value):
+        """
+        直方图记录一次观测值
+        :param name:
+        :param doc:
+        :param labels:
+        :param value:
+        :return:
+        """
+        with self.lock:
+            values, key = self._get(name, 'histogram', doc, labels)
+            # [各个bucket的计数..., sum, count]
+            hist = values.setdefault(key, [0] * (len(self.buckets) + 2))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    hist[i] += 1
+            hist[-2] += value
+            hist[-1] += 1
+
+    def remove(self, program):
+        """
+        删除带有该program标签的所有指标
+        :param program:
+        :return:
+        """
+        with self.lock:
+            for metric in self.metrics.values():
+                values = metric['values']
+                for key in [k for k in values if ('program', program) in k]:
+                    values.pop(key)
+
+    @staticmethod
+    def format_labels(labels, extra=()):
+        """
+        :param labels: ((key, value), ...)
+        :param extra: 附加的标签
+        :return: 如 {program="cat1",type="mem"}
+        """
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ''
+        escape = lambda v: str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        return '{%s}' % ','.join(['%s="%s"' % (k, escape(v)) for k, v in pairs])
+
+    def render(self):
+        """
+        输出Prometheus文本格式
+        :return: str
+        """
+        lines = []
+        with self.lock:
+            for name in sorted(self.metrics):
+                metric = self.metrics[name]
+                full_name = '%s_%s' % (self.prefix, name)
+                lines.append('# HELP %s %s' % (full_name, metric['doc']))
+                lines.append('# TYPE %s %s' % (full_name, metric['kind']))
+                for labels, value in sorted(iteritems(metric['values'])):
+                    if metric['kind'] != 'histogram':
+                        lines.append('%s%s %s' % (full_name, self.format_labels(labels), value))
+                        continue
+                    for bound, count in zip(self.buckets, value):
+                        lines.append('%s_bucket%s %s' % (full_name, self.format_labels(labels, [('le', bound)]),
+                                                         count))
+                    lines.append('%s_bucket%s %s' % (full_name, self.format_labels(labels, [('le', '+Inf')]),
+                                                     value[-1]))
+                    lines.append('%s_sum%s %s' % (full_name, self.format_labels(labels), value[-2]))
+                    lines.append('%s_count%s %s' % (full_name, self.format_labels(labels), value[-1]))
+        return '\n'.join(lines) + '\n'
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def start_metrics_server(metrics, port, addr=''):
+    """
+    在后台线程中启动 /metrics 接口
+    :param metrics: Metrics
+    :param port:
+    :param addr:
+    :return: server
+    """
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_response(404)
+                self.end_headers()
+                self.wfile.write(b'not found, use /metrics')
+                return
+            data = metrics.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            # 不输出访问日志
+            pass
+
+    server = ThreadingHTTPServer((addr, port), MetricsHandler)
+    t = threading.Thread(target=server.serve_forever)
+    t.setDaemon(True)
+    t.start()
+    return server
 
 
 class HealthCheck(object):
-    def __init__(self, config):
+    def __init__(self, config, config_file=None):
         """
         初始化配置
         :param config:
+        :param config_file: 配置文件路径, 设置后定期检查文件变化并重新加载程序配置
         """
 
         self.mail_config = None
         self.wechat_config = None
         self.supervisord_url = 'unix:///var/run/supervisor.sock'
+        self.supervisord_user = None
+        self.supervisord_pass = None
+        self.supervisord_cache_seconds = 1
+        self.supervisord_timeout_seconds = 5
+        self.max_workers = 10
+        self.snapshot_seconds = 1
+        self.host_refresh_seconds = 60
+        self.metrics_port = 0
+        self.metrics_addr = ''
+        self.reload_seconds = 5
+        self.global_config = None
+        self.discovery_config = None
+        self.state_file = None
+        self.state_flush_seconds = 1
+        self.process_watch_seconds = 0
+        self.jitter = True
+        notify_config = {}
+        restart_config = {}
+        probe_modules = {}
 
         if 'config' in config:
             self.mail_config = config['config'].get('mail')
@@ -163,9 +2035,80 @@ class HealthCheck(object):
             self.supervisord_url = config['config'].get('supervisordUrl', self.supervisord_url)
             self.supervisord_user = config['config'].get('supervisordUser', None)
             self.supervisord_pass = config['config'].get('supervisordPass', None)
-            config.pop('config')
-
-        self.program_config = config
+            self.supervisord_cache_seconds = config['config'].get('supervisordCacheSeconds',
+                                                                  self.supervisord_cache_seconds)
+            self.supervisord_timeout_seconds = config['config'].get('supervisordTimeoutSeconds',
+                                                                    self.supervisord_timeout_seconds)
+            self.max_workers = config['config'].get('maxWorkers', self.max_workers)
+            self.snapshot_seconds = config['config'].get('snapshotSeconds', self.snapshot_seconds)
+            self.host_refresh_seconds = config['config'].get('hostRefreshSeconds', self.host_refresh_seconds)
+            self.metrics_port = config['config'].get('metricsPort', self.metrics_port)
+            self.metrics_addr = config['config'].get('metricsAddr', self.metrics_addr)
+            probe_modules = config['config'].get('probes') or {}
+            notify_config = config['config'].get('notify') or {}
+            restart_config = config['config'].get('restart') or {}
+            self.reload_seconds = config['config'].get('reloadSeconds', self.reload_seconds)
+            self.discovery_config = config['config'].get('discovery')
+            self.state_file = config['config'].get('stateFile', self.state_file)
+            self.state_flush_seconds = config['config'].get('stateFlushSeconds', self.state_flush_seconds)
+            self.process_watch_seconds = config['config'].get('processWatchSeconds', self.process_watch_seconds)
+            self.jitter = config['config'].get('jitter', self.jitter)
+            self.global_config = config.pop('config')
+
+        self.config_file = config_file
+        self.config_stamp = self.get_config_stamp()
+        self.program_config = {}
+        self.file_config = config
+        self.discovered_config = {}
+        self.reconcile_lock = threading.Lock()
+        self.scheduler = None
+        self.check_state = {}
+        self.journal = None
+        if self.state_file:
+            self.journal = StateJournal(self.state_file, self.state_flush_seconds)
+            self.check_state = self.journal.load()
+        self.proc_table = ProcTable(self.snapshot_seconds)
+        self.process_pids = {}
+        self.periods = {}
+        self.windows = {}
+        self.supervisor_state = SupervisorState(functools.partial(self.get_supervisord_conn,
+                                                                  self.supervisord_timeout_seconds),
+                                                self.supervisord_cache_seconds)
+        self.http_pool = HTTPConnectionPool()
+        self.regex_cache = {}
+        self.tcp_prober = TcpProber()
+        self.io_sampler = RateSampler()
+        self.cgroup_sampler = RateSampler()
+        self.cgroup_cache = {}
+        self.host_identity = HostIdentity()
+        self.metrics = Metrics()
+        self.restart_governor = RestartGovernor(
+            max_concurrent=restart_config.get('maxConcurrent', 2),
+            rate_per_minute=restart_config.get('ratePerMinute', 10),
+            burst=restart_config.get('burst', 5),
+            backoff_seconds=restart_config.get('backoffSeconds', 30),
+            max_backoff_seconds=restart_config.get('maxBackoffSeconds', 600),
+            breaker_ratio=restart_config.get('breakerRatio', 0.5),
+            breaker_min_programs=restart_config.get('breakerMinPrograms', 4))
+        self.notifier = Notifier(self.log,
+                                 queue_size=notify_config.get('queueSize', 100),
+                                 retries=notify_config.get('retries', 3),
+                                 retry_seconds=notify_config.get('retrySeconds', 2),
+                                 dedup_seconds=notify_config.get('dedupSeconds', 60))
+        if self.mail_config:
+            self.mail_session = MailSession(self.mail_config.get('host', ''), self.mail_config.get('port', ''),
+                                            self.mail_config.get('user', ''), self.mail_config.get('pass', ''),
+                                            self.mail_config.get('to_list', []),
+                                            idle_seconds=self.mail_config.get('idleSeconds', 600))
+            self.mail_digest = None
+            if self.mail_config.get('digestSeconds'):
+                self.mail_digest = MailDigest(self.mail_session, self.mail_config['digestSeconds'], self.log,
+                                              retries=notify_config.get('retries', 3),
+                                              retry_seconds=notify_config.get('retrySeconds', 2))
+            self.notifier.register('email', self.action_email)
+        if self.wechat_config:
+            self.wechat_client = WechatClient(self.wechat_config.get('corpid'), self.wechat_config.get('secret'))
+            self.notifier.register('wechat', self.action_wechat)
 
         self.periodSeconds = 5
         self.failureThreshold = 3
@@ -176,36 +2119,369 @@ class HealthCheck(object):
         self.max_rss = 1024
         self.cumulative = False
         self.max_cpu = 90
+        self.max_fd = 1024
+        self.max_threads = 1000
+        self.max_sockets = 1000
+        self.max_io_rate = 100
+
+        self.probes = {
+            'http': self.http_check,
+            'tcp': self.tcp_check,
+            'mem': self.mem_check,
+            'cpu': self.cpu_check,
+            'fd': self.fd_check,
+            'threads': self.threads_check,
+            'sockets': self.sockets_check,
+            'io': self.io_check,
+        }
+        for name, path in iteritems(probe_modules):
+            self.load_probe(name, path)
+
+    def get_config_stamp(self):
+        """
+        获取配置文件的修改时间和大小, 用于判断文件是否变化
+        :return:
+        """
+        if not self.config_file:
+            return None
+        try:
+            st = os.stat(self.config_file)
+        except OSError:
+            return None
+        return st.st_mtime, st.st_size
+
+    def reload_config(self):
+        """
+        配置文件变化时重新加载程序配置, config部分的变化需要重启脚本才能生效
+        :return:
+        """
+        stamp = self.get_config_stamp()
+        if stamp is None or stamp == self.config_stamp:
+            return
+        self.config_stamp = stamp
+
+        try:
+            with open(self.config_file) as f:
+                config = yaml.safe_load(f) or {}
+        except Exception as e:
+            self.log('healthCheck:', 'reload config error: %s', e)
+            return
+
+        if config.pop('config', None) != self.global_config:
+            self.log('healthCheck:', 'config section changed, restart to apply')
+        self.file_config = config
+        added, removed, changed = self.apply_config()
+        self.log('healthCheck:', 'reload config, added: %s removed: %s changed: %s', added, removed, changed)
+
+    def discover(self):
+        """
+        通过getAllProcessInfo发现supervisor中的程序, 使用模板配置生成检查, 已在配置文件中配置的程序以配置文件为准
+        :return:
+        """
+        template = self.discovery_config.get('template') or {'type': 'mem'}
+        groups = self.discovery_config.get('groups') or {}
+        exclude = self.discovery_config.get('exclude') or []
+
+        # 本脚本由supervisor管理时不检查自己, 脚本可能经过多层包装启动, 排除所有祖先进程
+        own_pids = set([os.getpid()])
+        if HAS_PROCFS:
+            snapshot = self.proc_table.get()
+            stat = snapshot.get(os.getpid())
+            while stat is not None and stat.ppid not in (0, 1) and stat.ppid not in own_pids:
+                own_pids.add(stat.ppid)
+                stat = snapshot.get(stat.ppid)
+        else:
+            own_pids.add(os.getppid())
+
+        discovered = {}
+        for info in self.supervisor_state.all():
+            # 手动停止和正常退出的程序不检查, 避免被重启
+            if info['state'] in (0, 100):
+                continue
+            if info['pid'] in own_pids:
+                continue
+            program = info['name']
+            if info['group'] != info['name']:
+                program = '%s:%s' % (info['group'], info['name'])
+            if [p for p in exclude if fnmatch.fnmatch(program, p)]:
+                continue
+            item = dict(template)
+            item.update(groups.get(info['group']) or {})
+            # 自动发现的程序默认只发送通知, 需要重启时在模板中设置action
+            item.setdefault('action', 'email,wechat')
+            discovered[program] = item
+
+        if discovered != self.discovered_config:
+            self.discovered_config = discovered
+            added, removed, changed = self.apply_config()
+            self.log('healthCheck:', 'discovery, added: %s removed: %s changed: %s', added, removed, changed)
+
+    def apply_config(self):
+        """
+        合并自动发现和配置文件中的程序配置, 更新检查任务
+        :return: (added, removed, changed)
+        """
+        with self.reconcile_lock:
+            program_config = {}
+            for program, item in iteritems(self.discovered_config):
+                name = program.split(':')[-1]
+                if program not in self.file_config and name not in self.file_config:
+                    program_config[program] = item
+            program_config.update(self.file_config)
+            return self.reconcile(program_config)
+
+    def reconcile(self, program_config):
+        """
+        对比新旧程序配置, 只增删和替换有变化的检查任务, 未变化程序的检查任务和检查状态保持不变
+        :param program_config: {program: config}
+        :return: (added, removed, changed)
+        """
+        # 配置错误的程序不检查, 避免按检查失败执行动作
+        program_config = dict(program_config)
+        for program in list(program_config):
+            err = self.validate_config(program_config[program])
+            if err:
+                self.log(program, 'CONFIG: invalid, skip check, %s', err)
+                program_config.pop(program)
+
+        added, removed, changed = [], [], []
+        for program in list(self.program_config):
+            if program not in program_config:
+                self.scheduler.remove(program)
+                self.program_config.pop(program)
+                self.periods.pop(program, None)
+                for key in [k for k in self.windows if k == program or k.startswith(program + '#')]:
+                    self.windows.pop(key, None)
+                self.io_sampler.remove(program)
+                self.cgroup_sampler.remove(program)
+                self.metrics.remove(program)
+                self.drop_state(program)
+                removed.append(program)
+
+        for program, value in iteritems(program_config):
+            item = dict(value, program=program)
+            old = self.program_config.get(program)
+            if old == item:
+                continue
+            if old is None:
+                delay = item.get('initialDelaySeconds', self.initialDelaySeconds) + self.phase(program, item)
+                added.append(program)
+            else:
+                # 只修改阈值等参数时保留失败/成功计数, 检查类型变化时重新计数
+                if old.get('type') != item.get('type') or (
+                        [p.get('type') for p in old.get('probes') or []] !=
+                        [p.get('type') for p in item.get('probes') or []]):
+                    self.drop_state(program)
+                delay = item.get('periodSeconds', self.periodSeconds)
+                changed.append(program)
+            self.program_config[program] = item
+            self.log(program, 'CONFIG: %s', item)
+            self.scheduler.add(program, functools.partial(self.check, item),
+                               item.get('periodSeconds', self.periodSeconds), delay)
+
+        return added, removed, changed
+
+    def validate_config(self, config):
+        """
+        检查程序配置中的检查类型是否已注册
+        :param config:
+        :return: 错误信息, 配置正确时返回None
+        """
+        if not isinstance(config, dict):
+            return 'config must be a mapping'
+        probes = config.get('probes')
+        if probes:
+            if not isinstance(probes, list) or [p for p in probes if not isinstance(p, dict)]:
+                return 'probes must be a list of mappings'
+            types = [p.get('type', config.get('type', 'HTTP')) for p in probes]
+        else:
+            types = [config.get('type', 'HTTP')]
+        for check_type in types:
+            if str(check_type).lower() not in self.probes:
+                return 'unknown check type %s, types: %s' % (check_type, ','.join(sorted(self.probes)))
+        return None
+
+    def watch_processes(self):
+        """
+        对比getAllProcessInfo的结果, 进程被supervisord重新拉起(pid变化)时重置失败计数, 进程RUNNING后立即检查
+        :return:
+        """
+        self.supervisor_state.invalidate()
+        pids = {}
+        for program in list(self.program_config):
+            info = self.supervisor_state.get(program)
+            if info is None:
+                continue
+            pid, process_state = pids[program] = (info['pid'], info['state'])
+            old = self.process_pids.get(program)
+            if old is None or old == (pid, process_state):
+                continue
+
+            if pid and pid != old[0]:
+                self.log(program, 'pid changed %s -> %s, state %s', old[0], pid, info.get('statename'))
+                state = self.check_state.get(program)
+                if state and (state['failure'] or state['success'] or state.get('probes')):
+                    # 保留action, 恢复后仍可发送恢复通知
+                    state['failure'] = 0
+                    state['success'] = 0
+                    state['failing'] = False
+                    state.pop('probes', None)
+                    if self.journal:
+                        self.journal.record(program, state)
+                    self.metrics.set('failures', 'Current failure count of the program', {'program': program}, 0)
+                self.proc_table.invalidate()
+            if process_state == 20:
+                self.scheduler.trigger(program)
+        self.process_pids = pids
+
+    def phase(self, program, config):
+        """
+        按程序名称计算固定的启动偏移, 使各程序的检查均匀分布在一个周期内, 避免同时检查
+        :param program:
+        :param config:
+        :return: 偏移秒数
+        """
+        if not self.jitter:
+            return 0
+        period = config.get('periodSeconds', self.periodSeconds)
+        return (zlib.crc32(to_bytes(program)) & 0xffffffff) % 1000 / 1000.0 * period
+
+    def next_period(self, program, config, check_status):
+        """
+        自适应检查间隔: 检查失败时缩短到最小间隔, 检查成功时每次增加periodSeconds, 直到最大间隔
+        :param program:
+        :param config:
+        :param check_status:
+        :return: 下次检查的间隔(秒)
+        """
+        period = config.get('periodSeconds', self.periodSeconds)
+        min_period = config.get('minPeriodSeconds', 1)
+        max_period = config.get('maxPeriodSeconds', period * 6)
+        if check_status == 'success':
+            current = min(self.periods.get(program, period) + period, max_period)
+        elif check_status == 'failure':
+            current = min_period
+        else:
+            current = self.periods.get(program, period)
+        self.periods[program] = current
+        return current
+
+    def drop_state(self, program):
+        """
+        删除程序的检查状态
+        :param program:
+        :return:
+        """
+        if self.check_state.pop(program, None) is not None and self.journal:
+            self.journal.record(program, None)
+
+    def register_probe(self, name, func):
+        """
+        注册检查类型
+        :param name: 检查类型, 对应程序配置中的type
+        :param func: 检查函数, 参数为程序配置, 返回与 http_check 相同格式的dict
+        :return:
+        """
+        self.probes[name.lower()] = func
+
+    def load_probe(self, name, path):
+        """
+        从配置的模块路径加载检查函数
+        :param name: 检查类型
+        :param path: 模块路径, 如 mypkg.probes:disk_check, 函数参数为 (HealthCheck实例, 程序配置)
+        :return:
+        """
+        module_name, _, func_name = path.partition(':')
+        try:
+            func = getattr(importlib.import_module(module_name), func_name)
+        except (ImportError, AttributeError, ValueError) as e:
+            self.log('healthCheck:', 'PROBE: can not load %s from %s, %s', name, path, e)
+            return
+        self.register_probe(name, functools.partial(func, self))
 
-    def get_supervisord_conn(self):
+    def get_supervisord_conn(self, timeout=None):
         """
         获取supervisor的连接
+        :param timeout: 连接的socket超时时间(秒), 默认不超时
         :return:
         """
         transport = SupervisorTransport(self.supervisord_user, self.supervisord_pass, self.supervisord_url)
+        if timeout:
+            get_connection = transport._get_connection
+
+            def get_connection_with_timeout():
+                conn = get_connection()
+                connect = conn.connect
+
+                def connect_with_timeout():
+                    # unix socket的连接不使用HTTPConnection的timeout, 连接后单独设置
+                    connect()
+                    conn.sock.settimeout(timeout)
+
+                conn.connect = connect_with_timeout
+                return conn
+
+            transport._get_connection = get_connection_with_timeout
         s = ServerProxy('http://127.0.0.1', transport=transport)
 
         return s
 
-    def get_pid(self, program, kind, pid_file):
+    def resolve_pid(self, config, all_pids=False):
+        """
+        按程序配置获取进程pid
+        :param config:
+        :param all_pids: pidSelect为all时是否返回所有匹配的pid, 只有支持合计多个进程的检查(mem,cpu)使用
+        :return: (pid, err), all_pids为True且匹配到的是列表时pid为列表
+        """
+        # 多个检查共用probes_check中获取的pid
+        if 'resolvedPid' in config:
+            pid, err = config['resolvedPid'], config.get('resolvedPidError')
+        else:
+            pid, err = self.get_pid(config.get('program'), config.get('pidGet', 'supervisor'), config.get('pidFile', ),
+                                    config.get('pidMatch', 'contains'), config.get('pidName'),
+                                    config.get('pidSelect', 'lowest'))
+        if isinstance(pid, list) and not all_pids:
+            pid = pid[0]
+        return pid, err
+
+    def get_pid(self, program, kind, pid_file, match='contains', name=None, select='lowest'):
         """
         获取进程pid
         :param program:
         :param kind:
         :param pid_file:
-        :return:
+        :param match: kind为name时的匹配方式: exact,prefix,regex,contains
+        :param name: kind为name时搜索的命令行, 默认为program名称
+        :param select: kind为name时有多个进程匹配的处理: lowest(取pid最小的),all(返回所有匹配的pid)
+        :return: (pid, err), select为all时pid为从小到大排序的pid列表
         """
         pid = 0
         err = ''
 
         if kind == 'supervisor':
             try:
-                s = self.get_supervisord_conn()
-                info = s.supervisor.getProcessInfo(program)
-                pid = info.get('pid')
-                err = info.get('description')
+                info = self.supervisor_state.get(program)
+                if info:
+                    pid = info.get('pid')
+                    err = info.get('description')
+                else:
+                    err = "PID: program not found in supervisor"
+                    self.log(program, err)
             except Exception as e:
                 self.log(program, "PID: Can't get pid from supervisor %s ", e)
+        elif kind == 'name' and HAS_PROCFS:
+            name = name or program
+            try:
+                pids = self.proc_table.get().find(name, match)
+            except re.error as e:
+                pids = []
+                self.log(program, "PID: pidName regex %s error %s", name, e)
+            if pids:
+                # 默认只检查pid最小的进程, 通常是最先启动的主进程
+                pid = list(pids) if select == 'all' else pids[0]
+            else:
+                err = "PID: Can't get pid from name %s" % name
+                self.log(program, err)
         elif kind == 'name':
             pscommand = "ps -A -o pid,cmd |grep '[%s]%s' | awk '{print $1}' | head -1"
             exitcode, stdout, stderr = shell(pscommand % (program[0], program[1:]))
@@ -250,11 +2526,10 @@ class HealthCheck(object):
 
     def check(self, config):
         """
-        检查主函数
+        执行一次检查, 并根据结果更新检查状态
         :param config:
-        :return:
+        :return: 开启adaptive时返回下次检查的间隔(秒)
         """
-        check_state = {}
         program = config.get('program')
         periodSeconds = config.get('periodSeconds', self.periodSeconds)
         failureThreshold = config.get('failureThreshold', self.failureThreshold)
@@ -264,78 +2539,243 @@ class HealthCheck(object):
         action_type = config.get('action', 'restart')
 
         check_type = config.get('type', 'HTTP').lower()
-        check_method = self.http_check
+        if config.get('probes'):
+            check_type = 'probes'
+
+        if program not in self.check_state:
+            self.check_state[program] = {
+                'failure': 0,
+                'success': 0,
+                'action': False,
+                'failing': False
+            }
+        state = self.check_state[program]
+        before = json.dumps(state, sort_keys=True) if self.journal else None
+
+        # 进程启动中时检查结果没有意义, 跳过本次检查
+        if self.process_watch_seconds:
+            try:
+                info = self.supervisor_state.get(program)
+            except Exception:
+                info = None
+            if info and info['state'] in (10, 30):
+                self.log(program, '%s check: skip, process is %s', check_type.upper(), info.get('statename'))
+                self.metrics.inc('probes_skipped_total', 'Probes skipped while the process is starting',
+                                 {'program': program, 'type': check_type})
+                return
+
+        # self.log(program, '%s check state: %s', check_type, json.dumps(state))
+        if check_type == 'probes':
+            # 各检查已按自己的阈值判定, 合并结果出现1次失败即执行动作
+            check_status, check_result = self.probes_check(config, state)
+            failureThreshold = 1
+            successThreshold = 1
+        else:
+            check_status, check_result = self.run_probe(program, config)
+            # 窗口模式下以窗口的判定结果计数, 达到1次失败判定即执行动作
+            if config.get('window'):
+                failureThreshold = 1
+
+        now = time.time()
+        if check_status == 'failure':
+            state['failure'] += 1
+            if state['failure'] == 1:
+                state['failure_time'] = now
+        elif check_status == 'success':
+            state['success'] += 1
+
+        # 先判断成功次数
+        if state['success'] >= successThreshold:
+            # 只有开启恢复通知和检测失败并且执行操作后,才可以发送恢复通知
+            if sendResolved and state['action']:
+                # 只保留通知action
+                notice_action = ['email', 'wechat']
+                send_action = ','.join(list(set(action_type.split(',')) & set(notice_action)))
+                self.log(program, 'Use %s send resolved.', send_action)
+                action_param = {
+                    'check_status': check_status,
+                    'action_type': send_action,
+                    'msg': check_result.get('msg', '')
+                }
+                self.action(program, **action_param)
+
+            # 成功后,将项目状态初始化
+            state['failure'] = 0
+            state['success'] = 0
+            state['action'] = False
+            state.pop('failure_time', None)
+            self.restart_governor.reset(program)
+
+        failing = state['failure'] >= failureThreshold
+        if failing and config.get('adaptive', False):
+            # 自适应模式下失败后检查间隔会缩短, 失败阈值按periodSeconds换算为持续时间, 不因检查变快而提前触发
+            failing = now - state.get('failure_time', now) >= (failureThreshold - 1) * periodSeconds
+
+        # 达到失败阈值的程序数用于重启熔断
+        state['failing'] = failing
+
+        # 再判断失败次数
+        if failing:
+            # 失败后, 只触发一次action, 或者距上次action超过 2倍(periodSeconds+initialDelaySeconds) 个检查周期时再次触发(避免重启失败导致服务一直不可用)
+            repeat_seconds = (periodSeconds + initialDelaySeconds) * 2 * periodSeconds
+            if not state['action'] or now - state.get('action_time', 0) >= repeat_seconds:
+                action_param = {
+                    'config': config,
+                    'action_type': action_type,
+                    'check_status': check_status,
+                    'msg': check_result.get('msg', '')
+                }
+                self.action(program, **action_param)
+                state['action'] = True
+                state['action_time'] = now
 
-        if check_type == 'tcp':
-            check_method = self.tcp_check
-        elif check_type == 'mem':
-            check_method = self.mem_check
-        elif check_type == 'cpu':
-            check_method = self.cpu_check
+        self.metrics.set('failures', 'Current failure count of the program', {'program': program},
+                         state['failure'])
+        if self.journal and json.dumps(state, sort_keys=True) != before:
+            self.journal.record(program, state)
 
-        while 1:
-            if program not in check_state:
-                check_state[program] = {
-                    'periodSeconds': 1,
-                    'failure': 0,
-                    'success': 0,
-                    'action': False
-                }
-                self.log(program, 'CONFIG: %s', config)
-                time.sleep(initialDelaySeconds)
-
-            # self.log(program, '%s check state: %s', check_type, json.dumps(check_state[program]))
-            if check_state[program]['periodSeconds'] % periodSeconds == 0:
-                check_result = check_method(config)
-                check_status = check_result.get('status', None)
-                check_info = check_result.get('info', '')
-                self.log(program, '%s check: info(%s) state(%s)', check_type.upper(), check_info, check_status)
-
-                if check_status == 'failure':
-                    check_state[program]['failure'] += 1
-                elif check_status == 'success':
-                    check_state[program]['success'] += 1
-
-                # 先判断成功次数
-                if check_state[program]['success'] >= successThreshold:
-                    # 只有开启恢复通知和检测失败并且执行操作后,才可以发送恢复通知
-                    if sendResolved and check_state[program]['action']:
-                        # 只保留通知action
-                        notice_action = ['email', 'wechat']
-                        send_action = ','.join(list(set(action_type.split(',')) & set(notice_action)))
-                        self.log(program, 'Use %s send resolved.', send_action)
-                        action_param = {
-                            'check_status': check_status,
-                            'action_type': send_action,
-                            'msg': check_result.get('msg', '')
-                        }
-                        self.action(program, **action_param)
-
-                    # 成功后,将项目状态初始化
-                    check_state[program]['failure'] = 0
-                    check_state[program]['success'] = 0
-                    check_state[program]['action'] = False
-
-                # 再判断失败次数
-                if check_state[program]['failure'] >= failureThreshold:
-                    # 失败后, 只触发一次action, 或者检测错误数可以整除2倍periodSeconds与initialDelaySeconds时触发(避免重启失败导致服务一直不可用)
-                    if not check_state[program]['action'] or (
-                            check_state[program]['failure'] != 0 and check_state[program]['failure'] % (
-                            (periodSeconds + initialDelaySeconds) * 2) == 0):
-                        action_param = {
-						    'config': config,
-                            'action_type': action_type,
-                            'check_status': check_status,
-                            'msg': check_result.get('msg', '')
-                        }
-                        self.action(program, **action_param)
-                        check_state[program]['action'] = True
-
-                # 间隔时间清0
-                check_state[program]['periodSeconds'] = 0
-
-            time.sleep(1)
-            check_state[program]['periodSeconds'] += 1
+        if config.get('adaptive', False):
+            return self.next_period(program, config, check_status)
+
+    def run_probe(self, program, config, key=None, probe=''):
+        """
+        执行一次检查并记录指标, 设置了window时按窗口判定结果
+        :param program:
+        :param config:
+        :param key: 滑动窗口的标识, 默认为program
+        :param probe: 多个检查时检查的序号, 用作指标的probe标签
+        :return: (status, check_result)
+        """
+        check_type = config.get('type', 'HTTP').lower()
+        check_method = self.probes.get(check_type)
+
+        start = time.time()
+        if check_method:
+            check_result = check_method(config)
+        else:
+            check_result = {'status': 'unknown', 'msg': '[check] unknown check type %s' % check_type,
+                            'info': 'types: %s' % ','.join(sorted(self.probes))}
+        duration = time.time() - start
+        check_status = check_result.get('status', None)
+        self.record_metrics(program, check_type, check_result, duration, probe)
+
+        # unknown 表示无法判定(如cgroup不可用), 不计入失败或成功
+        if config.get('window') and check_status in ('failure', 'success'):
+            window_status = self.window_check(key or program, config['window'], check_result, duration)
+            check_info = check_result.get('info', '')
+            self.log(program, '%s check: info(%s) state(%s) window(%s)', check_type.upper(), check_info,
+                     check_status, window_status)
+            return window_status, check_result
+
+        check_info = check_result.get('info', '')
+        self.log(program, '%s check: info(%s) state(%s)', check_type.upper(), check_info, check_status)
+        return check_status, check_result
+
+    def probes_check(self, config, state):
+        """
+        执行程序配置的多个检查, 共用一次获取的pid和同一份进程快照, 每个检查按自己的阈值判定后合并结果
+        :param config: 程序配置, probes中的配置覆盖程序配置
+        :param state: 程序的检查状态, 各检查的计数保存在probes中
+        :return: (status, check_result)
+        """
+        program = config.get('program')
+        base = dict(config)
+        base.pop('probes')
+
+        pids = {}
+        probe_states = state.setdefault('probes', {})
+        failing = []
+        msgs = []
+        infos = []
+        for i, probe in enumerate(config['probes']):
+            probe_config = dict(base)
+            probe_config.update(probe)
+            # 获取pid的配置相同的检查共用一次获取的pid
+            pid_key = tuple([probe_config.get(k) for k in ('pidGet', 'pidFile', 'pidMatch', 'pidName', 'pidSelect')])
+            if pid_key not in pids:
+                pids[pid_key] = self.resolve_pid(probe_config, True)
+            probe_config['resolvedPid'], probe_config['resolvedPidError'] = pids[pid_key]
+            # CPU, IO等采样按检查区分, 同类型的多个检查互不影响
+            probe_config['probeKey'] = '%s#%s' % (program, i)
+            status, result = self.run_probe(program, probe_config, probe_config['probeKey'], str(i))
+
+            probe_state = probe_states.setdefault(str(i), {'failure': 0, 'success': 0})
+            if status == 'failure':
+                probe_state['failure'] += 1
+            elif status == 'success':
+                probe_state['success'] += 1
+            if probe_state['success'] >= probe_config.get('successThreshold', self.successThreshold):
+                probe_state['failure'] = 0
+                probe_state['success'] = 0
+            threshold = 1 if probe_config.get('window') else probe_config.get('failureThreshold',
+                                                                               self.failureThreshold)
+            failing.append(probe_state['failure'] >= threshold)
+            msgs.append(result.get('msg', ''))
+            infos.append('%s:%s' % (probe_config.get('type', 'HTTP').lower(), 'failure' if failing[-1] else 'ok'))
+
+        if config.get('verdict', 'any') == 'all':
+            failed = all(failing)
+        else:
+            failed = any(failing)
+        check_status = 'failure' if failed else 'success'
+        check_info = ' '.join(infos)
+        self.log(program, 'PROBES check: info(%s) verdict(%s) state(%s)', check_info, config.get('verdict', 'any'),
+                 check_status)
+        return check_status, {'status': check_status, 'msg': '\r\n '.join(msgs), 'info': check_info}
+
+    def window_check(self, key, window_config, check_result, duration):
+        """
+        把本次结果加入滑动窗口, 按窗口判定是否失败: 最近size次中失败次数达到failures, 或窗口满时耗时百分位数超过阈值
+        :param key: 窗口标识, 单个检查时为program
+        :param window_config: {size, failures, latencySeconds, percentile}
+        :param check_result: 本次检查结果, 窗口信息会追加到msg和info中
+        :param duration: 检查耗时(秒)
+        :return: failure, success
+        """
+        size = window_config.get('size', 10)
+        failures = window_config.get('failures', self.failureThreshold)
+        latency_seconds = window_config.get('latencySeconds', 0)
+        percentile = window_config.get('percentile', 95)
+
+        window = self.windows.get(key)
+        if window is None or window.size != size:
+            window = self.windows[key] = ProbeWindow(size)
+        window.add(check_result.get('status') == 'failure', check_result.get('latency', duration))
+
+        failed = window.failures >= failures
+        info = 'window: %s/%s failed' % (window.failures, window.count)
+        # 只在设置了耗时阈值且窗口已满时计算百分位数, 避免每次检查都排序
+        if latency_seconds and window.count == size:
+            latency = window.percentile(percentile)
+            if latency > latency_seconds:
+                failed = True
+            info = '%s p%s:%.3fs' % (info, percentile, latency)
+
+        check_result['info'] = '%s %s' % (check_result.get('info', ''), info)
+        check_result['msg'] = '%s\r\n %s' % (check_result.get('msg', ''), info)
+        return 'failure' if failed else 'success'
+
+    def record_metrics(self, program, check_type, check_result, duration, probe=''):
+        """
+        记录检查结果指标
+        :param program:
+        :param check_type:
+        :param check_result:
+        :param duration: 检查耗时(秒)
+        :param probe: 多个检查时检查的序号, 单个检查时为空
+        :return:
+        """
+        labels = {'program': program, 'type': check_type, 'probe': probe}
+        # http,tcp检查使用结果中的响应时间, 其他检查使用检查耗时
+        self.metrics.observe('probe_latency_seconds', 'Probe latency in seconds', labels,
+                             check_result.get('latency', duration))
+        self.metrics.inc('probes_total', 'Total probes by result', dict(labels, status=check_result.get('status')))
+        if 'rss' in check_result:
+            self.metrics.set('rss_megabytes', 'Last measured memory of the program in MB',
+                             {'program': program, 'probe': probe}, check_result['rss'])
+        if 'cpu' in check_result:
+            self.metrics.set('cpu_percent', 'Last measured cpu usage of the program',
+                             {'program': program, 'probe': probe}, check_result['cpu'])
 
     def http_check(self, config):
         """
@@ -356,6 +2796,10 @@ class HealthCheck(object):
 
         config_username = config.get('username', '')
         config_password = config.get('password', '')
+        config_keepAlive = config.get('keepAlive', True)
+        config_expectStatus = config.get('expectStatus', httplib.OK)
+        config_maxLatencySeconds = config.get('maxLatencySeconds', 0)
+        config_maxBodyBytes = config.get('maxBodyBytes', 65536)
 
         HEADERS = {'User-Agent': 'leops http_check'}
 
@@ -381,21 +2825,111 @@ class HealthCheck(object):
         check_info = '%s %s %s %s %s %s' % (config_host, config_port, config_path, config_method,
                                             config_body, headers)
 
+        httpClient = None
+        timings = {'connect': 0, 'ttfb': 0, 'total': 0}
         try:
-            httpClient = httplib.HTTPConnection(config_host, config_port, timeout=config_timeoutSeconds)
-            httpClient.request(config_method, config_path, config_body, headers=headers)
-            res = httpClient.getresponse()
+            # 复用的连接可能已被服务端关闭, 此时使用新连接重试一次
+            for retry in (True, False):
+                reused = False
+                if config_keepAlive:
+                    httpClient, reused = self.http_pool.get(config_host, config_port, config_timeoutSeconds)
+                else:
+                    httpClient = httplib.HTTPConnection(config_host, config_port, timeout=config_timeoutSeconds)
+                start = time.time()
+                try:
+                    if httpClient.sock is None:
+                        httpClient.connect()
+                    timings['connect'] = time.time() - start
+                    httpClient.request(config_method, config_path, config_body, headers=headers)
+                    res = httpClient.getresponse()
+                    timings['ttfb'] = time.time() - start
+                    break
+                except socket.timeout:
+                    raise
+                except (httplib.HTTPException, socket.error):
+                    httpClient.close()
+                    if not (retry and reused):
+                        raise
+            # 最多读取 maxBodyBytes, 避免大响应体拖慢检查
+            body = res.read(config_maxBodyBytes)
+            timings['total'] = time.time() - start
         except Exception as e:
-            self.log(program, 'HTTP: conn error, %s', e)
-            return {'status': 'failure', 'msg': '[http_check] %s' % e, 'info': check_info}
-        finally:
             if httpClient:
                 httpClient.close()
+            self.log(program, 'HTTP: conn error, %s', e)
+            return {'status': 'failure', 'msg': '[http_check] %s' % e, 'info': check_info, 'timings': timings}
+
+        # 响应体未读完的连接不能复用
+        if config_keepAlive and not res.will_close and res.isclosed():
+            self.http_pool.put(config_host, config_port, httpClient)
+        else:
+            httpClient.close()
 
-        if res.status != httplib.OK:
-            return {'status': 'failure', 'msg': '[http_check] return code %s' % res.status, 'info': check_info}
+        latency = timings['total']
+        check_info = '%s connect:%.3fs ttfb:%.3fs total:%.3fs' % (check_info, timings['connect'], timings['ttfb'],
+                                                                  latency)
+        result = {'status': 'success', 'msg': '[http_check] return code %s' % res.status, 'info': check_info,
+                  'timings': timings, 'latency': latency}
 
-        return {'status': 'success', 'msg': '[http_check] return code %s' % res.status, 'info': check_info}
+        errors = []
+        try:
+            expect_ranges = parse_status_ranges(config_expectStatus)
+        except ValueError as e:
+            self.log(program, 'HTTP: expectStatus not loads: %s , %s', config_expectStatus, e)
+            expect_ranges = [(httplib.OK, httplib.OK)]
+        if not [r for r in expect_ranges if r[0] <= res.status <= r[1]]:
+            errors.append('return code %s' % res.status)
+        if config_maxLatencySeconds and latency > float(config_maxLatencySeconds):
+            errors.append('latency %.3fs exceeds %ss' % (latency, config_maxLatencySeconds))
+        body_error = self.http_body_check(config, body, not res.isclosed())
+        if body_error:
+            errors.append(body_error)
+
+        if errors:
+            result['status'] = 'failure'
+            result['msg'] = '[http_check] %s' % ', '.join(errors)
+
+        return result
+
+    def http_body_check(self, config, body, truncated=False):
+        """
+        检查http响应体
+        :param config:
+        :param body: 读取到的响应体
+        :param truncated: 响应体是否超过maxBodyBytes被截断
+        :return: 错误信息, 检查通过时返回空字符串
+        """
+        body_contains = config.get('bodyContains', '')
+        body_regex = config.get('bodyRegex', '')
+        body_json_path = config.get('bodyJsonPath', '')
+
+        if not (body_contains or body_regex or body_json_path):
+            return ''
+
+        text = body.decode('utf-8', 'replace')
+        if body_contains and body_contains not in text:
+            return 'body not contains %s' % body_contains
+        if body_regex:
+            regex = self.regex_cache.get(body_regex)
+            if regex is None:
+                try:
+                    regex = re.compile(body_regex)
+                except re.error as e:
+                    self.log(config.get('program'), 'HTTP: invalid bodyRegex %s, %s', body_regex, e)
+                    return 'invalid bodyRegex %s: %s' % (body_regex, e)
+                self.regex_cache[body_regex] = regex
+            if not regex.search(text):
+                return 'body not match %s' % body_regex
+        if body_json_path:
+            if truncated:
+                return 'body exceeds %s bytes, can not parse json' % config.get('maxBodyBytes', 65536)
+            try:
+                value = json_path_get(json.loads(text), body_json_path)
+            except (KeyError, IndexError, TypeError, ValueError) as e:
+                return 'body json path %s not found: %s' % (body_json_path, e)
+            if 'bodyJsonValue' in config and value != config['bodyJsonValue']:
+                return 'body json path %s is %s, expect %s' % (body_json_path, value, config['bodyJsonValue'])
+        return ''
 
     def tcp_check(self, config):
         """
@@ -407,16 +2941,25 @@ class HealthCheck(object):
         host = config.get('host', 'localhost')
         port = config.get('port', 80)
         timeoutSeconds = config.get('timeoutSeconds', 3)
+        send = config.get('send', '')
+        expect = config.get('expect', '')
+        read_bytes = config.get('readBytes', 1024)
         check_info = '%s %s' % (host, port)
-        try:
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.settimeout(timeoutSeconds)
-            sock.connect((host, port))
-            sock.close()
-        except Exception as e:
-            self.log(program, 'TCP: conn error, %s', e)
-            return {'status': 'failure', 'msg': '[tcp_check] %s' % e, 'info': check_info}
-        return {'status': 'success', 'msg': '[tcp_check] connection succeeded', 'info': check_info}
+
+        probe = self.tcp_prober.probe(host, port, timeoutSeconds, send, expect, read_bytes)
+        timings = {'connect': probe['connect'], 'total': probe['total']}
+        check_info = '%s connect:%.3fs total:%.3fs' % (check_info, probe['connect'], probe['total'])
+        if not probe['event'].is_set() and not probe['error']:
+            probe['error'] = 'timed out'
+        if probe['error']:
+            self.log(program, 'TCP: conn error, %s', probe['error'])
+            return {'status': 'failure', 'msg': '[tcp_check] %s' % probe['error'], 'info': check_info,
+                    'timings': timings, 'latency': probe['connect']}
+
+        msg = '[tcp_check] connection succeeded'
+        if expect:
+            msg = '[tcp_check] connection succeeded, got %r' % expect
+        return {'status': 'success', 'msg': msg, 'info': check_info, 'timings': timings, 'latency': probe['connect']}
 
     def mem_check(self, config):
         """
@@ -427,24 +2970,151 @@ class HealthCheck(object):
         program = config.get('program')
         max_rss = config.get('maxRss', self.max_rss)
         cumulative = config.get('cumulative', self.cumulative)
-        pid_get = config.get('pidGet', 'supervisor')
-        pid_file = config.get('pidFile', )
-        check_info = 'max_rss:%sMB cumulative:%s' % (max_rss, cumulative)
+        mem_type = config.get('memType', 'rss').lower()
+        top_children = config.get('topChildren', 3)
+        check_info = 'max_rss:%sMB cumulative:%s mem_type:%s' % (max_rss, cumulative, mem_type)
 
-        pid, err = self.get_pid(program, pid_get, pid_file)
+        pid, err = self.resolve_pid(config, True)
         if pid == 0:
             self.log(program, 'MEM: check error, program not starting')
             return {'status': 'failure',
                     'msg': '[mem_check] program not starting, message: %s' % err,
                     'info': check_info}
-        now_rss = get_proc_rss(pid, cumulative)
+        # pidSelect为all时合计所有匹配的进程, cgroup和ps方式只统计pid最小的进程
+        pids = pid if isinstance(pid, list) else [pid]
+        pid = ','.join([str(p) for p in pids])
+
+        children = []
+        if config.get('accounting') == 'cgroup':
+            now_rss, cgroup, err = self.cgroup_mem(pids[0], mem_type)
+            if now_rss is None:
+                # cgroup不可用是配置或环境问题, 不计为程序检查失败
+                self.log(program, 'MEM: cgroup accounting unavailable, %s', err)
+                return {'status': 'unknown', 'msg': '[mem_check] %s' % err,
+                        'info': '%s pid:%s' % (check_info, pid)}
+            now_rss = now_rss / 1024
+            check_info = '%s cgroup:%s' % (check_info, cgroup)
+        elif HAS_PROCFS:
+            now_rss, usage = self.proc_table.get().mem(pids if len(pids) > 1 else pids[0], cumulative, mem_type)
+            if now_rss is not None:
+                now_rss = now_rss / 1024  # 单位是 KB， 这里转为MB单位
+                # 按内存从大到小取前 top_children 个子进程
+                children = sorted([u for u in usage if u[0] not in pids], key=lambda u: u[1],
+                                  reverse=True)[:top_children]
+                children = [(p, m / 1024) for p, m in children]
+        else:
+            now_rss = get_proc_rss(pids[0], cumulative)
         check_info = '%s now_rss:%sMB pid:%s' % (check_info, now_rss, pid)
-        if now_rss >= int(max_rss):
-            return {'status': 'failure', 'msg': '[mem_check] max_rss(%sMB) now_rss(%sMB)' % (max_rss, now_rss),
+        if now_rss is None:
+            return {'status': 'failure', 'msg': '[mem_check] can not get %s of pid %s' % (mem_type, pid),
                     'info': check_info}
 
-        return {'status': 'success', 'msg': '[mem_check] max_rss(%sMB) now_rss(%sMB)' % (max_rss, now_rss),
-                'info': check_info}
+        msg = '[mem_check] max_rss(%sMB) now_rss(%sMB)' % (max_rss, now_rss)
+        if children:
+            msg = '%s top_children(%s)' % (msg, ', '.join(['%s:%sMB' % c for c in children]))
+        result = {'status': 'success', 'msg': msg, 'info': check_info, 'rss': now_rss, 'children': children}
+        if now_rss >= int(max_rss):
+            result['status'] = 'failure'
+
+        return result
+
+    def get_cgroup(self, pid):
+        """
+        获取进程所在cgroup v2的目录, cgroup中有进程树以外的进程(如supervisord和其他程序)时拒绝使用,
+        脱离进程树的子进程(父进程为1)视为程序自己的进程.
+        同一进程(pid和启动时间相同)只在首次或cgroup变化时校验, 之后只读取 /proc/<pid>/stat 和 /proc/<pid>/cgroup
+        :param pid:
+        :return: (目录, err)
+        """
+        if CGROUP2_ROOT is None:
+            return None, 'cgroup v2 is not mounted'
+        stat = read_proc_stat(pid)
+        if stat is None:
+            return None, 'pid %s not found' % pid
+        path = read_proc_cgroup(pid)
+        if path is None:
+            return None, 'can not read cgroup v2 of pid %s' % pid
+        if path == '/':
+            return None, 'pid %s is in the root cgroup' % pid
+        cgroup = CGROUP2_ROOT + path
+        if self.cgroup_cache.get(stat.pid) == (stat.start_time, path):
+            return cgroup, None
+
+        err = self.validate_cgroup(pid, cgroup)
+        if err:
+            return None, err
+        # 清理已退出进程的记录
+        for cached_pid in [p for p in list(self.cgroup_cache) if not os.path.exists('/proc/%d' % p)]:
+            self.cgroup_cache.pop(cached_pid, None)
+        self.cgroup_cache[stat.pid] = (stat.start_time, path)
+        return cgroup, None
+
+    def validate_cgroup(self, pid, cgroup):
+        """
+        检查cgroup中是否只有程序的进程树
+        :param pid:
+        :param cgroup: cgroup目录
+        :return: err, 可以使用时为None
+        """
+        try:
+            with open(os.path.join(cgroup, 'cgroup.procs')) as f:
+                procs = [int(line) for line in f if line.strip()]
+        except (IOError, OSError, ValueError):
+            return 'can not read %s/cgroup.procs' % cgroup
+        snapshot = self.proc_table.get()
+        tree = snapshot.tree(pid, True)
+        if not tree:
+            return 'pid %s not found' % pid
+        tree_pids = set([stat.pid for stat in tree])
+        for p in procs:
+            if p in tree_pids:
+                continue
+            stat = snapshot.get(p)
+            if p == tree[0].ppid or (stat is not None and stat.ppid != 1):
+                return 'cgroup %s is shared with pid %s outside the program' % (cgroup, p)
+        return None
+
+    def cgroup_mem(self, pid, mem_type):
+        """
+        按cgroup统计内存, rss为memory.stat中的anon, current为memory.current(包含page cache)
+        :param pid:
+        :param mem_type: rss,current
+        :return: (内存KB, cgroup目录, err)
+        """
+        cgroup, err = self.get_cgroup(pid)
+        if cgroup is None:
+            return None, None, err
+        if mem_type == 'current':
+            try:
+                with open(os.path.join(cgroup, 'memory.current')) as f:
+                    return int(f.read()) / 1024, cgroup, None
+            except (IOError, OSError, ValueError):
+                return None, cgroup, 'can not read %s/memory.current' % cgroup
+        if mem_type != 'rss':
+            return None, cgroup, 'memType %s is not supported by cgroup accounting' % mem_type
+        stat = read_cgroup_stat(cgroup, 'memory.stat')
+        if stat is None or 'anon' not in stat:
+            return None, cgroup, 'can not read %s/memory.stat' % cgroup
+        return stat['anon'] / 1024, cgroup, None
+
+    def cgroup_cpu(self, program, pid):
+        """
+        按cgroup统计CPU使用率, 为两次采样间cpu.stat中usage_usec的差值
+        :param program: 采样者标识
+        :param pid:
+        :return: (CPU使用率%, cgroup目录, err), 首次采样没有使用率, 返回(None, cgroup目录, None)
+        """
+        cgroup, err = self.get_cgroup(pid)
+        if cgroup is None:
+            return None, None, err
+        stat = read_cgroup_stat(cgroup, 'cpu.stat')
+        if stat is None or 'usage_usec' not in stat:
+            return None, cgroup, 'can not read %s/cpu.stat' % cgroup
+        rate = self.cgroup_sampler.rate(program, cgroup, stat['usage_usec'])
+        if rate is None:
+            return None, cgroup, None
+        # 每秒的CPU微秒数转为百分比
+        return round(rate / 10000.0, 2), cgroup, None
 
     def cpu_check(self, config):
         """
@@ -454,26 +3124,135 @@ class HealthCheck(object):
         """
         program = config.get('program')
         max_cpu = config.get('maxCpu', self.max_cpu)
-        pid_get = config.get('pidGet', 'supervisor')
-        pid_file = config.get('pidFile', )
         check_info = 'max_cpu:{cpu}%'.format(cpu=max_cpu)
 
-        pid, err = self.get_pid(program, pid_get, pid_file)
+        pid, err = self.resolve_pid(config, True)
         if pid == 0:
             self.log(program, 'CPU: check error, program not starting')
             return {'status': 'failure',
                     'msg': '[cpu_check] program not starting, message: %s' % err,
                     'info': check_info}
-        now_cpu = get_proc_cpu(pid)
+        # pidSelect为all时合计所有匹配的进程, cgroup和ps方式只统计pid最小的进程
+        pids = pid if isinstance(pid, list) else [pid]
+        pid = ','.join([str(p) for p in pids])
+        if config.get('accounting') == 'cgroup':
+            now_cpu, cgroup, err = self.cgroup_cpu(config.get('probeKey', program), pids[0])
+            if now_cpu is None and err is None:
+                # 首次采样没有使用率, 下次检查时再判定
+                return {'status': 'unknown', 'msg': '[cpu_check] first sample of cgroup %s' % cgroup,
+                        'info': '{info} cgroup:{cgroup} pid:{pid}'.format(info=check_info, cgroup=cgroup, pid=pid)}
+            if now_cpu is None:
+                self.log(program, 'CPU: cgroup accounting unavailable, %s', err)
+                return {'status': 'unknown', 'msg': '[cpu_check] %s' % err,
+                        'info': '{info} pid:{pid}'.format(info=check_info, pid=pid)}
+            check_info = '{info} cgroup:{cgroup}'.format(info=check_info, cgroup=cgroup)
+        elif HAS_PROCFS:
+            now_cpu = self.proc_table.get().cpu(pids if len(pids) > 1 else pids[0], config.get('probeKey', program))
+        else:
+            now_cpu = get_proc_cpu(pids[0], config.get('probeKey', program))
         check_info = '{info} now_cpu:{now}% pid:{pid}'.format(info=check_info, now=now_cpu, pid=pid)
+        if now_cpu is None:
+            return {'status': 'failure', 'msg': '[cpu_check] can not get cpu of pid {pid}'.format(pid=pid),
+                    'info': check_info}
         if now_cpu >= int(max_cpu):
             return {'status': 'failure',
                     'msg': '[cpu_check] max_cpu({max_cpu}%) now_cpu({now}%)'.format(max_cpu=max_cpu, now=now_cpu),
-                    'info': check_info}
+                    'info': check_info, 'cpu': now_cpu}
 
         return {'status': 'success',
                 'msg': '[cpu_check] max_cpu({max_cpu}%) now_cpu({now}%)'.format(max_cpu=max_cpu, now=now_cpu),
-                'info': check_info}
+                'info': check_info, 'cpu': now_cpu}
+
+    def proc_check(self, config, name, max_value, measure, unit=''):
+        """
+        进程内指标检查的公共流程: 获取pid, 读取指标, 与阈值比较
+        :param config:
+        :param name: 检查名称
+        :param max_value: 阈值, 大于等于阈值为检测失败
+        :param measure: 读取指标的函数, 参数为 (program, pid), 返回 (值, 附加信息), 值为None表示读取失败
+        :param unit: 单位
+        :return: dict
+        """
+        program = config.get('program')
+        check_info = 'max_%s:%s%s' % (name, max_value, unit)
+
+        pid, err = self.resolve_pid(config)
+        if pid == 0:
+            self.log(program, '%s: check error, program not starting', name.upper())
+            return {'status': 'failure',
+                    'msg': '[%s_check] program not starting, message: %s' % (name, err),
+                    'info': check_info}
+
+        value, extra = measure(program, pid)
+        check_info = ('%s now_%s:%s%s pid:%s %s' % (check_info, name, value, unit, pid, extra)).strip()
+        if value is None:
+            return {'status': 'failure', 'msg': '[%s_check] can not get %s of pid %s' % (name, name, pid),
+                    'info': check_info}
+
+        result = {'status': 'success', 'info': check_info, 'value': value,
+                  'msg': '[%s_check] max_%s(%s%s) now_%s(%s%s)' % (name, name, max_value, unit, name, value, unit)}
+        if value >= float(max_value):
+            result['status'] = 'failure'
+        return result
+
+    def fd_check(self, config):
+        """
+        用于检查进程打开的文件描述符数量
+        :param config:
+        :return: dict
+        """
+        def measure(program, pid):
+            fds = read_proc_fds(pid)
+            return (len(fds) if fds is not None else None), ''
+
+        return self.proc_check(config, 'fd', config.get('maxFd', self.max_fd), measure)
+
+    def threads_check(self, config):
+        """
+        用于检查进程的线程数量
+        :param config:
+        :return: dict
+        """
+        def measure(program, pid):
+            status = read_proc_status(pid)
+            if not status or 'Threads' not in status:
+                return None, ''
+            return int(status['Threads']), ''
+
+        return self.proc_check(config, 'threads', config.get('maxThreads', self.max_threads), measure)
+
+    def sockets_check(self, config):
+        """
+        用于检查进程打开的socket数量
+        :param config:
+        :return: dict
+        """
+        def measure(program, pid):
+            fds = read_proc_fds(pid)
+            if fds is None:
+                return None, ''
+            return len([fd for fd in fds if fd.startswith('socket:')]), ''
+
+        return self.proc_check(config, 'sockets', config.get('maxSockets', self.max_sockets), measure)
+
+    def io_check(self, config):
+        """
+        用于检查进程的磁盘读写速率
+        :param config:
+        :return: dict
+        """
+        def measure(program, pid):
+            io = read_proc_io(pid)
+            if io is None:
+                return None, ''
+            rate = self.io_sampler.rate(config.get('probeKey', program), pid,
+                                        io.get('read_bytes', 0) + io.get('write_bytes', 0))
+            if rate is None:
+                # 首次采样没有速率
+                return 0, 'first sample'
+            return round(rate / 1024 / 1024, 2), ''
+
+        return self.proc_check(config, 'io', config.get('maxIoRate', self.max_io_rate), measure, 'MB/s')
 
     def action(self, program, **args):
         """
@@ -489,65 +3268,103 @@ class HealthCheck(object):
 		
         self.log(program, 'Action: %s', action_type)
         action_list = action_type.split(',')
+        for name in action_list:
+            self.metrics.inc('actions_total', 'Total actions taken', {'program': program, 'action': name,
+                                                                      'status': check_status})
 
         if 'restart' in action_list:
-            restart_result = self.action_supervisor_restart(program)
+            states = list(self.check_state.values())
+            decision = self.restart_governor.acquire(program, len([st for st in states if st.get('failing')]),
+                                                     len(states))
+            self.metrics.inc('restart_decisions_total', 'Restart governor decisions',
+                             {'program': program, 'decision': decision})
+            if decision == 'allowed':
+                try:
+                    restart_result = self.action_supervisor_restart(program, config.get('restartTimeoutSeconds', 60))
+                finally:
+                    self.restart_governor.release()
+            else:
+                restart_result = 'skipped, %s' % decision
+                self.log(program, 'Action: restart skipped, %s', decision)
             msg += '\r\n Restart：%s' % restart_result
         elif 'exec' in action_list:
             action_exec_cmd = config.get('action_exec_cmd')
             exec_result = self.action_exec(program, action_exec_cmd)
             msg += '\r\n Exec：%s' % exec_result
         elif 'kill' in action_list:
-            pid_get = config.get('pidGet', 'supervisor')
-            pid_file = config.get('pidFile', )
-            pid, err = self.get_pid(program, pid_get, pid_file)
+            pid, err = self.resolve_pid(config)
             kill_result = self.action_kill(program, pid)
             msg += '\r\n Kill：%s' % kill_result
 
-        if 'email' in action_list and self.mail_config:
-            self.action_email(program, action_type, msg, check_status)
-        if 'wechat' in action_list and self.wechat_config:
-            self.action_wechat(program, action_type, msg, check_status)
+        # 通知异步发送, 不阻塞检查
+        for channel in ('email', 'wechat'):
+            if channel in action_list:
+                self.notifier.notify(channel, program, action_type, msg, check_status)
 
-    def action_supervisor_restart(self, program):
+    def action_supervisor_restart(self, program, timeout=60):
         """
         通过supervisor的rpc接口重启进程
+        stopProcess/startProcess 使用wait=True, 由supervisord等待进程状态变更, 启动后确认进程为RUNNING
         :param program:
+        :param timeout: 从停止到进程RUNNING的最长等待时间(秒)
         :return:
         """
         self.log(program, 'Action: restart')
-        result = 'success'
+        start = time.time()
         try:
-            s = self.get_supervisord_conn()
-            info = s.supervisor.getProcessInfo(program)
+            info = self.supervisor_state.get(program)
+            if info is None:
+                info = self.supervisor_state.call('getProcessInfo', program)
+            # stopProcess/startProcess 会阻塞到进程状态变更, 使用单独的连接, 避免阻塞其他检查获取pid
+            s = self.get_supervisord_conn(timeout)
         except Exception as e:
             result = 'Get %s ProcessInfo Error: %s' % (program, e)
             self.log(program, 'Action: restart %s' % result)
             return result
 
-        if info['state'] == 20:
-            self.log(program, 'Action: restart stop process')
+        try:
+            if info['state'] == 20:
+                self.log(program, 'Action: restart stop process')
+                try:
+                    stop_result = s.supervisor.stopProcess(program, True)
+                    self.log(program, 'Action: restart stop result %s', stop_result)
+                except Fault as e:
+                    # 进程已经停止时继续启动
+                    if e.faultCode != 70:
+                        result = 'Failed to stop process %s, exiting: %s' % (program, e)
+                        self.log(program, 'Action: restart stop error %s', result)
+                        return result
+
+            self.log(program, 'Action: restart start process')
             try:
-                stop_result = s.supervisor.stopProcess(program)
-                self.log(program, 'Action: restart stop result %s', stop_result)
+                start_result = s.supervisor.startProcess(program, True)
+                self.log(program, 'Action: restart start result %s', start_result)
             except Fault as e:
-                result = 'Failed to stop process %s, exiting: %s' % (program, e)
-                self.log(program, 'Action: restart stop error %s', result)
-                return result
+                # 进程已被supervisord自动拉起时以实际状态为准
+                if e.faultCode != 60:
+                    result = 'Failed to start process %s, exiting: %s' % (program, e)
+                    self.log(program, 'Action: restart start error %s', result)
+                    return result
 
-            time.sleep(1)
             info = s.supervisor.getProcessInfo(program)
+        except Exception as e:
+            result = 'Failed to restart process %s, exiting: %s' % (program, e)
+            self.log(program, 'Action: restart error %s', result)
+            return result
+        finally:
+            self.supervisor_state.invalidate()
+            s('close')()
 
+        elapsed = time.time() - start
         if info['state'] != 20:
-            self.log(program, 'Action: restart start process')
-            try:
-                start_result = s.supervisor.startProcess(program)
-            except Fault as e:
-                result = 'Failed to start process %s, exiting: %s' % (program, e)
-                self.log(program, 'Action: restart start error %s', result)
-                return result
-            self.log(program, 'Action: restart start result %s', start_result)
-
+            result = 'Process %s is %s after restart' % (program, info.get('statename', info['state']))
+        elif elapsed > timeout:
+            result = 'Process %s is RUNNING after %.2fs, exceeding %ss' % (program, elapsed, timeout)
+        else:
+            self.metrics.observe('restart_seconds', 'Time from restart to RUNNING in seconds', {'program': program},
+                                 elapsed)
+            result = 'success, RUNNING after %.2fs' % elapsed
+        self.log(program, 'Action: restart result %s', result)
         return result
 
     def action_exec(self, program, cmd):
@@ -605,18 +3422,10 @@ class HealthCheck(object):
         """
         self.log(program, 'Action: email')
 
-        ip = ""
-        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        try:
-            s.connect(('8.8.8.8', 80))
-            ip = s.getsockname()[0]
-        except Exception as e:
-            self.log(program, 'Action: email get ip error %s' % e)
-        finally:
-            s.close()
-
-        hostname = platform.node().split('.')[0]
-        system_platform = platform.platform()
+        host_info = self.host_identity.info
+        ip = host_info['ip']
+        hostname = host_info['hostname']
+        system_platform = host_info['platform']
 
         if check_status == 'success':
             subject = "[Supervisor] %s Health check successful" % program
@@ -633,21 +3442,14 @@ class HealthCheck(object):
         Msg: {msg}
         """.format(curr_dt=curr_dt, program=program, ip=ip, hostname=hostname, system_platform=system_platform,
                    action=action_type, msg=msg)
-        mail_port = self.mail_config.get('port', '')
-        mail_host = self.mail_config.get('host', '')
-        mail_user = self.mail_config.get('user', '')
-        mail_pass = self.mail_config.get('pass', '')
-        to_list = self.mail_config.get('to_list', [])
 
-        msg = MIMEText(content, _subtype='plain', _charset='utf-8')
-        msg['Subject'] = Header(subject, 'utf-8')
-        msg['From'] = mail_user
-        msg['to'] = ",".join(to_list)
+        if self.mail_digest:
+            self.mail_digest.add(subject, content)
+            self.log(program, 'Action: email add to digest.')
+            return True
+
         try:
-            s = smtplib.SMTP_SSL(mail_host, mail_port)
-            s.login(mail_user, mail_pass)
-            s.sendmail(mail_user, to_list, msg.as_string())
-            s.quit()
+            self.mail_session.send(subject, content)
         except Exception as e:
             self.log(program, 'Action: email send error %s' % e)
             return False
@@ -666,46 +3468,15 @@ class HealthCheck(object):
         """
         self.log(program, 'Action: wechat')
 
-        host = "qyapi.weixin.qq.com"
-
-        corpid = self.wechat_config.get('corpid')
-        secret = self.wechat_config.get('secret')
         agentid = self.wechat_config.get('agentid')
         touser = self.wechat_config.get('touser')
         toparty = self.wechat_config.get('toparty')
         totag = self.wechat_config.get('totag')
 
-        headers = {
-            'Content-Type': 'application/json'
-        }
-
-        access_token_url = '/cgi-bin/gettoken?corpid={id}&corpsecret={crt}'.format(id=corpid, crt=secret)
-        try:
-            httpClient = httplib.HTTPSConnection(host, timeout=10)
-            httpClient.request("GET", access_token_url, headers=headers)
-            response = httpClient.getresponse()
-            token = json.loads(response.read())['access_token']
-        except Exception as e:
-            self.log(program, 'Action: wechat get token error %s' % e)
-            return False
-        finally:
-            if httpClient:
-                httpClient.close()
-
-        send_url = '/cgi-bin/message/send?access_token={token}'.format(token=token)
-
-        ip = ""
-        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        try:
-            s.connect(('8.8.8.8', 80))
-            ip = s.getsockname()[0]
-        except Exception as e:
-            self.log(program, 'Action: wechat get ip error %s' % e)
-        finally:
-            s.close()
-
-        hostname = platform.node().split('.')[0]
-        system_platform = platform.platform()
+        host_info = self.host_identity.info
+        ip = host_info['ip']
+        hostname = host_info['hostname']
+        system_platform = host_info['platform']
 
         curr_dt = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
 
@@ -740,19 +3511,13 @@ class HealthCheck(object):
             data['totag'] = totag
 
         try:
-            httpClient = httplib.HTTPSConnection(host, timeout=10)
-            httpClient.request("POST", send_url, json.dumps(data), headers=headers)
-            response = httpClient.getresponse()
-            result = json.loads(response.read())
-            if result['errcode'] != 0:
+            result = self.wechat_client.send(data)
+            if result.get('errcode') != 0:
                 self.log(program, 'Action: wechat send faild %s' % result)
                 return False
         except Exception as e:
             self.log(program, 'Action: wechat send error %s' % e)
             return False
-        finally:
-            if httpClient:
-                httpClient.close()
 
         self.log(program, 'Action: wechat send success')
         return True
@@ -763,25 +3528,42 @@ class HealthCheck(object):
         :return:
         """
         self.log('healthCheck:', 'start')
-        threads = []
-
-        for key, value in iteritems(self.program_config):
-            item = value
-            item['program'] = key
-            t = threading.Thread(target=self.check, args=(item,))
-            threads.append(t)
-        for t in threads:
+        scheduler = Scheduler(self.max_workers)
+
+        if self.metrics_port:
+            start_metrics_server(self.metrics, self.metrics_port, self.metrics_addr)
+            self.log('healthCheck:', 'metrics listen on %s:%s/metrics', self.metrics_addr, self.metrics_port)
+
+        self.scheduler = scheduler
+        self.apply_config()
+
+        if self.discovery_config:
+            reconcile_seconds = self.discovery_config.get('reconcileSeconds', 30)
             try:
-                t.setDaemon(True)
-                t.start()
-            except Exception, e:
-                print('Exception in ' + t.getName() + ' (catch by main)')
-                print(t.exc_traceback)
-                t.setDaemon(True)
-                t.start()
-                
-        while 1:
-            time.sleep(0.1)
+                self.discover()
+            except Exception as e:
+                self.log('healthCheck:', 'discovery error: %s', e)
+            scheduler.add('__discovery', self.discover, reconcile_seconds, reconcile_seconds)
+
+        if self.process_watch_seconds:
+            scheduler.add('__process_watch', self.watch_processes, self.process_watch_seconds)
+
+        # 回放的状态中已不再检查的程序
+        for program in list(self.check_state):
+            if program not in self.program_config:
+                self.drop_state(program)
+
+        if self.config_file and self.reload_seconds:
+            scheduler.add('__reload_config', self.reload_config, self.reload_seconds, self.reload_seconds)
+
+        scheduler.add('__host_identity', self.host_identity.refresh, self.host_refresh_seconds,
+                      self.host_refresh_seconds)
+
+        if self.mail_config:
+            keepalive_seconds = self.mail_config.get('keepaliveSeconds', 60)
+            scheduler.add('__mail_keepalive', self.mail_session.keepalive, keepalive_seconds, keepalive_seconds)
+
+        scheduler.run()
 
 
 if __name__ == '__main__':
@@ -803,12 +3585,52 @@ config:                                          # 脚本配置名称,请勿更
 #  supervisordUrl: http://localhost:9001/RPC2    # supervisor的接口地址, 默认使用本地socket文件unix:///var/run/supervisor.sock
 #  supervisordUser: user                         # supervisor中设置的username, 没有设置可不填
 #  supervisordPass: pass                         # supervisor中设置的password, 没有设置可不填
+#  supervisordCacheSeconds: 1                    # getAllProcessInfo结果的缓存时间(秒), 默认: 1
+#  supervisordTimeoutSeconds: 5                  # 调用supervisor接口的超时时间(秒), 默认: 5
+#  maxWorkers: 10                                # 同时执行检测的线程数, 默认: 10
+#  metricsPort: 9105                             # Prometheus指标接口端口, 访问 /metrics, 默认: 0 不启动
+#  metricsAddr: 127.0.0.1                        # 指标接口监听地址, 默认: 所有地址
+#  reloadSeconds: 5                              # 检查配置文件变化的间隔(秒), 程序配置变化时自动重新加载, 0为不检查, 默认: 5
+#  discovery:                                    # 自动发现supervisor中的程序并按模板检查, 已在本文件配置的程序以本文件为准
+#    reconcileSeconds: 30                        # 重新发现程序的间隔(秒), 默认: 30
+#    exclude: ['healthcheck', 'grp:*']           # 不自动检查的程序, 支持通配符, 状态为STOPPED,EXITED的程序和本脚本不检查
+#    template:                                   # 发现的程序使用的检查配置, 同下方程序配置, 默认: type: mem
+#      type: mem
+#      maxRss: 1024
+#      action: email                             # 自动发现的程序默认: email,wechat 只发送通知, 不重启
+#    groups:                                     # 按supervisor的group覆盖模板中的配置
+#      grp:
+#        maxRss: 2048
+#  stateFile: /var/lib/healthCheck.state         # 检查状态的保存文件, 重启脚本后恢复失败计数和已执行的动作, 默认: 不保存
+#  stateFlushSeconds: 1                          # 检查状态批量写入文件的间隔(秒), 默认: 1
+#  processWatchSeconds: 0                        # 对比supervisor进程状态的间隔(秒), pid变化时重置失败计数并立即检查, 进程STARTING,BACKOFF时跳过检查, 默认: 0 不开启
+#  jitter: True                                  # 按程序名称错开各程序首次检查的时间, 避免同时检查, 默认: True
+#  hostRefreshSeconds: 60                        # 检查本机网络变化并刷新通知中ip的间隔(秒), 默认: 60
+#  restart:                                      # 重启限流配置, 避免依赖故障时同时重启大量程序
+#    maxConcurrent: 2                            # 同时进行的重启数, 默认: 2
+#    ratePerMinute: 10                           # 每分钟最多重启次数, 默认: 10
+#    burst: 5                                    # 允许的突发重启次数, 默认: 5
+#    backoffSeconds: 30                          # 同一程序再次重启的最小间隔(秒), 每次重启后翻倍, 默认: 30
+#    maxBackoffSeconds: 600                      # 重启间隔上限(秒), 默认: 600
+#    breakerRatio: 0.5                           # 失败程序占比超过该值时停止重启, 默认: 0.5
+#    breakerMinPrograms: 4                       # 检查的程序数少于该值时不熔断, 默认: 4
+#  notify:                                       # 通知发送配置
+#    queueSize: 100                              # 每个通知通道的队列长度, 默认: 100
+#    retries: 3                                  # 发送失败的重试次数, 默认: 3
+#    retrySeconds: 2                             # 首次重试等待时间(秒), 之后每次翻倍, 默认: 2
+#    dedupSeconds: 60                            # 同一程序的状态与上一次发送的相同时, 该时间(秒)内只发送一次, 默认: 60
+#  probes:                                       # 自定义检查类型, 值为 模块:函数, 函数参数为 (HealthCheck实例, 程序配置)
+#    disk: mypkg.probes:disk_check
+#  snapshotSeconds: 1                            # mem,cpu检查共用进程表快照的有效时间(秒), 默认: 1
 #  mail:                                         # stmp配置
 #    host: 'smtp.test.com'
 #    port': '465'
 #    user': 'ops@test.com'
 #    pass': '123456'
 #    to_list: ['test@test.com']
+#    keepaliveSeconds: 60                        # smtp连接保活(NOOP)的间隔(秒), 默认: 60
+#    idleSeconds: 600                            # 超过该时间(秒)没有邮件时关闭smtp连接, 默认: 600
+#    digestSeconds: 0                            # 该时间(秒)内的邮件合并为一封发送, 发送失败时按notify的retries重试, 默认: 0 不合并
 #  wechat:                                       # 企业微信通知配置
 #    corpid: 
 #    secret: 
@@ -819,23 +3641,39 @@ config:                                          # 脚本配置名称,请勿更
 
 # 内存方式监控
 cat1:                     # supervisor中配置的program名称
-  type: mem               # 检查类型: http,tcp,mem,cpu  默认: http
+  type: mem               # 检查类型: http,tcp,mem,cpu,fd,threads,sockets,io 默认: http
   maxRss: 1024            # 内存阈值, 超过则为检测失败. 单位MB, 默认: 1024
   cumulative: True        # 是否统计子进程的内存, 默认: False
+  memType: rss            # 内存统计方式: rss,pss,uss, pss和uss需要内核4.14+的smaps_rollup, accounting为cgroup时支持rss(anon),current(含page cache) 默认: rss
+  accounting: process     # 统计方式: process(按进程或进程树),cgroup(按进程所在cgroup v2, 需要程序运行在自己的cgroup中) 默认: process
+  topChildren: 3          # cumulative为True时, 在结果中列出内存最大的几个子进程, 默认: 3
   pidGet: supervisor      # 获取pid的方式: supervisor,name,file, 选择name时,按program名称搜索pid,选择file时,需指定pidFile 默认: supervisor
   pidFile: /var/run/t.pid # 指定pid文件的路径, 只在pidGet为file的时候有用
+  pidName: cat1           # pidGet为name时搜索的命令行, 默认: program名称
+  pidSelect: lowest       # pidGet为name时有多个进程匹配的处理: lowest(取pid最小的),all(mem,cpu检查合计所有匹配的进程,其他检查取pid最小的) 默认: lowest
+  pidMatch: contains      # pidGet为name时的匹配方式: exact,prefix,regex,contains 默认: contains
   periodSeconds: 10       # 检查的频率(以秒为单位), 默认: 5
-  initialDelaySeconds: 10 # 首次检查等待的时间(以秒为单位), 默认: 1
+  adaptive: False         # 自适应检查频率, 检查成功时逐步延长间隔, 失败时缩短到最小间隔, 默认: False
+  minPeriodSeconds: 1     # adaptive为True时的最小间隔(秒), 默认: 1
+  maxPeriodSeconds: 60    # adaptive为True时的最大间隔(秒), 默认: periodSeconds的6倍
+  window:                 # 按最近size次检查结果判定失败, 设置后failureThreshold不生效, 默认: 不开启
+    size: 10              # 窗口大小, 默认: 10
+    failures: 3           # 窗口内失败次数达到该值判定为失败, 默认: failureThreshold
+    latencySeconds: 0.5   # 窗口满时耗时百分位数超过该值判定为失败, http,tcp为响应时间, 默认: 0 不检查
+    percentile: 95        # 耗时百分位, 默认: 95
+  initialDelaySeconds: 10 # 首次检查等待的时间(以秒为单位), jitter为True时再加上按程序名称计算的0~periodSeconds秒, 默认: 1
   failureThreshold: 3     # 检查成功后，最少连续检查失败多少次才被认定为失败, 默认: 3
   successThreshold: 2     # 失败后检查成功的最小连续成功次数, 默认：1
   action: restart,email   # 触发的动作: restart,exec,email,wechat (restart和exec互斥,同时设置时restart生效) 默认: restart
   execCmd: command        # action exec 的执行命令
+  restartTimeoutSeconds: 60 # action restart 从停止到进程RUNNING的最长等待时间(秒), 默认: 60
   sendResolved: True      # 是否发送恢复通知,仅用作于email,wechat. 默认: False
 
 # cpu方式监控
 cat2:                     # supervisor中配置的program名称
-  type: cpu               # 检查类型: http,tcp,mem,cpu 默认: http
+  type: cpu               # 检查类型: http,tcp,mem,cpu,fd,threads,sockets,io 默认: http
   maxCpu: 80              # CPU阈值, 超过则为检测失败. 单位% 默认: 90%
+  accounting: process     # 统计方式: process(按进程),cgroup(按进程所在cgroup v2的cpu.stat, 首次检查只采样, 结果为unknown) 默认: process
   pidGet: supervisor      # 获取pid的方式: supervisor,name,file, 选择name时,按program名称搜索pid,选择file时,需指定pidFile 默认: supervisor
   pidFile: /var/run/t.pid # 指定pid文件的路径, 只在pidGet为file的时候有用
   periodSeconds: 10       # 检查的频率(以秒为单位), 默认: 5
@@ -844,8 +3682,21 @@ cat2:                     # supervisor中配置的program名称
   successThreshold: 2     # 失败后检查成功的最小连续成功次数, 默认：1
   action: restart,email   # 触发的动作: restart,exec,email,wechat (restart和exec互斥,同时设置时restart生效) 默认: restart
   execCmd: command        # action exec 的执行命令
+  restartTimeoutSeconds: 60 # action restart 从停止到进程RUNNING的最长等待时间(秒), 默认: 60
   sendResolved: True      # 是否发送恢复通知,仅用作于email,wechat. 默认: False
 
+# 进程内指标监控, 通过/proc读取, 不需要额外执行命令
+cat5:
+  type: fd                # 检查类型: fd(文件描述符数),threads(线程数),sockets(socket数),io(磁盘读写速率)
+  maxFd: 1024             # fd阈值, 默认: 1024
+  maxThreads: 1000        # threads阈值, 默认: 1000
+  maxSockets: 1000        # sockets阈值, 默认: 1000
+  maxIoRate: 100          # io阈值, 单位MB/s, 默认: 100
+  pidGet: supervisor      # 获取pid的方式: supervisor,name,file, 选择name时,按program名称搜索pid,选择file时,需指定pidFile 默认: supervisor
+  periodSeconds: 10       # 检查的频率(以秒为单位), 默认: 5
+  failureThreshold: 3     # 检查成功后，最少连续检查失败多少次才被认定为失败, 默认: 3
+  action: restart,email   # 触发的动作: restart,exec,email,wechat (restart和exec互斥,同时设置时restart生效) 默认: restart
+
 # HTTP方式监控
 cat3:
   type: HTTP
@@ -857,6 +3708,14 @@ cat3:
   hearders: '{"c":1}'     # http的hearder头部数据
   username: test          # 用于http的basic认证
   password: pass          # 用于http的basic认证
+  keepAlive: True         # 是否复用http连接, 设置为False时每次检查都新建连接(可检测到accept队列异常), 默认: True
+  expectStatus: 200-299   # 期望的状态码, 支持范围和多个值, 如 200-299,301 默认: 200
+  maxLatencySeconds: 0.5  # 响应时间阈值(秒), 超过则为检测失败, 默认: 0 不检查
+  maxBodyBytes: 65536     # 最多读取的响应体字节数, 默认: 65536
+  bodyContains: ok        # 响应体需包含的字符串
+  bodyRegex: 'db.+ok'     # 响应体需匹配的正则
+  bodyJsonPath: $.db      # 响应体json中需存在的路径, 以.分隔, 数组使用下标
+  bodyJsonValue: ok       # bodyJsonPath对应的期望值
   periodSeconds: 10       # 检查的频率(以秒为单位), 默认: 5
   initialDelaySeconds: 10 # 首次检查等待的时间(以秒为单位), 默认: 1
   timeoutSeconds: 5       # 检查超时的秒数, 默认: 3
@@ -864,6 +3723,7 @@ cat3:
   successThreshold: 2     # 失败后检查成功的最小连续成功次数, 默认：1
   action: restart,email   # 触发的动作: restart,exec,email,wechat (restart和exec互斥,同时设置时restart生效) 默认: restart
   execCmd: command        # action exec 的执行命令
+  restartTimeoutSeconds: 60 # action restart 从停止到进程RUNNING的最长等待时间(秒), 默认: 60
   sendResolved: True      # 是否发送恢复通知,仅用作于email,wechat. 默认: False
 
 # TCP方式监控
@@ -871,6 +3731,9 @@ cat4:
   type: TCP
   host: 127.0.0.1         # 主机地址, 默认: localhost
   port: 8082              # 检测端口，默认: 80
+  send: "PING\\r\\n"        # 连接后发送的数据, 如redis的PING
+  expect: "+PONG"         # 期望在响应中出现的数据, 如redis返回的+PONG, 不设置时只检测连接
+  readBytes: 1024         # 最多读取的响应字节数, 默认: 1024
   periodSeconds: 10       # 检查的频率(以秒为单位), 默认: 5
   initialDelaySeconds: 10 # 首次检查等待的时间(以秒为单位), 默认: 1
   timeoutSeconds: 5       # 检查超时的秒数, 默认: 3
@@ -878,6 +3741,24 @@ cat4:
   successThreshold: 2     # 失败后检查成功的最小连续成功次数, 默认：1
   action: restart,email   # 触发的动作: restart,exec,email,wechat (restart和exec互斥,同时设置时restart生效) 默认: restart
   execCmd: command        # action exec 的执行命令
+  restartTimeoutSeconds: 60 # action restart 从停止到进程RUNNING的最长等待时间(秒), 默认: 60
+  sendResolved: True      # 是否发送恢复通知,仅用作于email,wechat. 默认: False
+
+# 多个检查方式监控, 共用一次获取的pid和进程快照
+cat6:
+  probes:                 # 检查列表, 每项同单个检查的配置, 未设置的参数使用本程序的配置
+    - type: mem
+      maxRss: 1024
+      failureThreshold: 3 # 每个检查使用自己的阈值判定是否失败
+    - type: cpu
+      maxCpu: 80
+      failureThreshold: 5
+    - type: http
+      port: 8080
+      path: /health
+  verdict: any            # 合并结果: any(任一检查失败即失败),all(所有检查失败才失败) 默认: any
+  periodSeconds: 10       # 检查的频率(以秒为单位), 默认: 5
+  action: restart,email   # 触发的动作: restart,exec,email,wechat (restart和exec互斥,同时设置时restart生效) 默认: restart
   sendResolved: True      # 是否发送恢复通知,仅用作于email,wechat. 默认: False
 """
         with open(config_file, 'w') as f:
@@ -890,5 +3771,5 @@ cat4:
     with open(config_file) as f:
         config = yaml.safe_load(f)
 
-    check = HealthCheck(config)
+    check = HealthCheck(config, config_file)
     check.start()
@@ -0,0 +1,42 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# @Desc    : 对比supervisor_healthCheck中 /proc 采样与 ps 命令获取进程内存、CPU的耗时
+#            用法: python supervisor_healthCheck_benchmark.py [pid] [count]
+
+
+import os
+import sys
+import time
+
+from supervisor_healthCheck import get_proc_rss, get_proc_cpu, get_proc_rss_ps, get_proc_cpu_ps
+
+
+def bench(name, func, count, *args):
+    """
+    执行count次func, 输出总耗时和单次平均耗时
+    :param name:
+    :param func:
+    :param count:
+    :param args:
+    :return:
+    """
+    result = None
+    start = time.time()
+    for _ in range(count):
+        result = func(*args)
+    cost = time.time() - start
+    print('%-28s total: %8.3fs  avg: %8.3fms  result: %s' % (name, cost, cost * 1000 / count, result))
+
+
+if __name__ == '__main__':
+    pid = int(sys.argv[1]) if len(sys.argv) > 1 else os.getppid()
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+
+    print('pid: %s count: %s' % (pid, count))
+    bench('ps   rss', get_proc_rss_ps, count, pid)
+    bench('proc rss', get_proc_rss, count, pid)
+    bench('ps   rss cumulative', get_proc_rss_ps, count, pid, True)
+    bench('proc rss cumulative', get_proc_rss, count, pid, True)
+    bench('ps   cpu', get_proc_cpu_ps, count, pid)
+    bench('proc cpu', get_proc_cpu, count, pid)